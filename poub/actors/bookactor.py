@@ -1,17 +1,34 @@
 import logging
-from functools import partial
+import time
+from datetime import date, datetime, timedelta
+from typing import Optional
 
-from pykka import ThreadingActor, ActorRef
+from pykka import ActorDeadError, ThreadingActor, ActorRef
 
 from actorutil.event import EventEmitter
-from actorutil.forward import ask_forwarding
-from .browser import BookResult
+from actorutil.forward import ForwardingHandle, ask_forwarding
+from actorutil.metrics import InstrumentedActor
+from .browser import BookResult, BookTurnResult
+from .dtactor import BookingPlan
 from .userdb import User
-from building import BuildingTurn
+from building import BuildingTurn, CellLocation
+from config import config
+from runtrace import tracer
 from waiter import waiter
 
+# Number of users logged in by the warm-up before midnight
+WARM_UP_USERS = int(config.get('WARM_UP_USERS', 10))
+# The warm-up stops logging in users this many seconds before midnight
+WARM_UP_MARGIN = float(config.get('WARM_UP_MARGIN', 2 * 60))
+# Seconds to wait for the links and then for the bookings of each user, the polling of the buildings
+# and the booking queue give up a bit earlier and return what they have done
+RESOLVE_TIMEOUT = float(config.get('RESOLVE_TIMEOUT', 25 * 60))
+BOOKING_TIMEOUT = float(config.get('BOOKING_TIMEOUT', 35 * 60))
+# Seconds given to the 'booked' listeners before moving on
+NOTIFY_TIMEOUT = float(config.get('NOTIFY_TIMEOUT', 60))
 
-class BookActor(ThreadingActor):
+
+class BookActor(InstrumentedActor, ThreadingActor):
     def __init__(self, dtactor: ActorRef, browser: ActorRef, userdb: ActorRef):
         super().__init__()
         self.events = EventEmitter()
@@ -21,32 +38,146 @@ class BookActor(ThreadingActor):
 
         self._waiter_midnight = None
         self._waiter_pre_midnight = None
+        self._waiter_warm_up = None
+        self._plan = None  # type: Optional[BookingPlan]
+        # Users of the current run not booked yet
+        self._run_pending = 0
+        # Asks of the current run, cancelled if a new run starts before it ends
+        self._run_asks = []  # type: list[ForwardingHandle]
+        self._run_id = 0
 
     def on_start(self) -> None:
         self._waiter_midnight = waiter.add(lambda: self.actor_ref.proxy().book(), hour=0, minute=0, second=0, microsecond=10)
-        # Pre-Update timetables at 23:50 to be faster
-        self._waiter_pre_midnight = waiter.add(lambda: self.dtactor.proxy().update_timetable(), hour=23, minute=50, second=0, microsecond=0)
+        # Pre-Update timetables and plan the bookings at 23:50 to be faster
+        self._waiter_pre_midnight = waiter.add(lambda: self.actor_ref.proxy().prepare(), hour=23, minute=50, second=0, microsecond=0)
+        # Warm up the browser and log in the first users so at midnight only the bookings are left
+        self._waiter_warm_up = waiter.add(lambda: self.actor_ref.proxy().warm_up(), hour=23, minute=55, second=0, microsecond=0)
 
     def on_stop(self) -> None:
         waiter.remove(self._waiter_midnight)
         waiter.remove(self._waiter_pre_midnight)
+        waiter.remove(self._waiter_warm_up)
+        self._cancel_run()
+
+    def _cancel_run(self):
+        for x in self._run_asks:
+            x.cancel()
+        self._run_asks = []
+        try:
+            self.browser.proxy().cancel_run(self._run_id)
+        except ActorDeadError:
+            # Shutting down
+            pass
 
-    def on_booked(self, user: User, book_res: BookResult):
+    def on_booked(self, user: User, book_res: BookResult, start: float):
         logging.info(f"Booking done")
+        tracer.add('user', start, user=user.username, ok=len(book_res.remaining) == 0)
+
+        # The run ends when the users have been notified
+        if self.events.has_listeners('booked'):
+            self.events.emit('booked', user, book_res, timeout=NOTIFY_TIMEOUT,
+                             then=lambda _results: self.actor_ref.proxy().on_user_done())
+        else:
+            self.on_user_done()
+
+    def on_booking_error(self, user: User, start: float):
+        # Which turns have been booked is unknown, better not to tell the user anything wrong
+        tracer.add('user', start, user=user.username, ok=False)
+        self.on_user_done()
 
-        self.events.emit('booked', user, book_res)
+    def on_user_done(self):
+        self._run_pending -= 1
+        if self._run_pending == 0:
+            self._run_asks = []
+            tracer.finish_run()
+
+    def on_receipt(self, user: User, index: int, turn: BookTurnResult):
+        self.events.emit('receipt', user, index, turn)
 
     def _on_links(self, user: User, bookings: set[BuildingTurn]):
         logging.info(f"Booking: {', '.join(f'{x.room} ({x.trange})' for x in bookings)} for {user.username}")
-        ask_forwarding(self.browser, 'process_bookings', user.username, user.password, bookings,
-                       then=lambda booking_res: self.actor_ref.proxy().on_booked(user, booking_res))
+        start = time.monotonic()
+
+        def on_error(exc_info):
+            logging.error(f"Bookings of {user.username} failed", exc_info=exc_info)
+            self.actor_ref.proxy().on_booking_error(user, start)
+
+        self._run_asks.append(ask_forwarding(
+            self.browser, 'process_bookings', user.username, user.password, bookings,
+            lambda index, turn: self.actor_ref.proxy().on_receipt(user, index, turn), run=self._run_id,
+            timeout=BOOKING_TIMEOUT,
+            then=lambda booking_res: self.actor_ref.proxy().on_booked(user, booking_res, start), on_error=on_error))
+
+    def prepare(self):
+        """Plans the bookings of the next day so that after midnight only the building pages are needed"""
+        self.dtactor.proxy().update_timetable()
+
+        users = self.userdb.proxy().get_bookable_users().get()  # type: list[User]
+        tomorrow = date.today() + timedelta(days=1)
+        ask_forwarding(self.dtactor, 'plan_bookings', tomorrow, {x.tid: list(x.subjects) for x in users},
+                       then=lambda plan: self.actor_ref.proxy().on_plan(plan))
+
+    def on_plan(self, plan: BookingPlan):
+        self._plan = plan
+
+    def warm_up(self):
+        users = self.userdb.proxy().get_bookable_users().get()  # type: list[User]
+        plan = self._plan
+        planned = {}  # type: dict[int, list[CellLocation]]
+        if plan is not None:
+            # Only the users with something to book tomorrow
+            planned = {tid: x[1] for tid, x in plan.users.items()}
+            users = [x for x in users if len(planned.get(x.tid, [])) > 0]
+        midnight = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+        timeout = (midnight - datetime.now()).total_seconds() - WARM_UP_MARGIN
+        if timeout <= 0:
+            logging.warning('Too late for the warm-up')
+            return
+        ask_forwarding(self.browser, 'warm_up', [(x.username, x.password, planned.get(x.tid, [])) for x in users],
+                       WARM_UP_USERS, timeout=timeout,
+                       on_error=lambda exc_info: logging.warning('Warm-up not started in time'))
 
     def book(self):
         logging.info(f"Booking started...")
+        if len(self._run_asks) > 0:
+            logging.warning('The last booking run has not finished yet, cancelling it')
+            self._cancel_run()
+        self._run_id += 1
+        tracer.start_run('booking')
+
+        plan = self._plan
+        self._plan = None
+        if plan is not None and plan.day != date.today():
+            plan = None
 
         users = self.userdb.proxy().get_bookable_users().get()  # type: list[User]
         logging.info(f'Booking {len(users)} users')
+        lectures = {}  # type: dict[int, list[tuple[str, str]]]
+        located = {}  # type: dict[int, list[CellLocation]]
         for user in users:
-            ask_forwarding(self.dtactor, 'resolve_links', user.subjects, then=partial(self._on_links, user))
+            planned = plan.users.get(user.tid) if plan is not None else None
+            if planned is not None and planned[0] == user.subjects:
+                located[user.tid] = planned[1]
+            else:
+                # Subjects changed after the plan was made
+                lectures[user.tid] = user.subjects
 
+        start = time.monotonic()
+        self._run_asks.append(ask_forwarding(
+            self.dtactor, 'resolve_links_batch', lectures, located, timeout=RESOLVE_TIMEOUT,
+            then=lambda links: self.actor_ref.proxy().on_batch_links(users, start, links),
+            on_error=lambda exc_info: self.actor_ref.proxy().on_links_error(exc_info)))
 
+    def on_links_error(self, exc_info):
+        logging.error('Cannot resolve the links, no booking today', exc_info=exc_info)
+        self._run_asks = []
+        tracer.finish_run()
+
+    def on_batch_links(self, users: list[User], start: float, links: dict[int, set[BuildingTurn]]):
+        tracer.add('resolve_links', start)
+        self._run_asks = []
+        self._run_pending = len(users)
+        if len(users) == 0:
+            tracer.finish_run()
+        for user in users:
+            self._on_links(user, links.get(user.tid, set()))
@@ -2,22 +2,57 @@ import logging
 import time
 import uuid
 import base64
-from dataclasses import dataclass
+import os
+import re
+import signal
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Optional, NamedTuple
+from typing import Callable, Iterator, Optional, NamedTuple, Union
+from urllib.parse import urljoin, urlparse
 
 import pykka
+import requests
+from lxml import html
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException, ElementNotInteractableException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
+from actorutil.forward import current_deadline
+from actorutil.metrics import InstrumentedActor
 from building import BuildingTurn
+from config import config
+from runtrace import tracer
+from sessions import SessionStore, cookie_matches, sessions
 
 
 LOGIN_URL = 'https://idp.unimore.it'
+# 'selenium' or 'http' (falls back to selenium when the http booking fails)
+BOOKING_BACKEND = config.get('BOOKING_BACKEND', 'selenium')
+HTTP_TIMEOUT = 30
+# Any booking page (e.g. an old booking link), the warm-up opens it to preload the site and log in the users.
+# Without it the link of the last turn booked since the start is used, and there's nothing to preload before that
+BOOKING_URL = config.get('BOOKING_URL')
+# The warm-up logs in again the users whose session expires in less than this (seconds)
+WARM_UP_SESSION_MARGIN = float(config.get('WARM_UP_SESSION_MARGIN', 60 * 60))
+# The browser is restarted after this many bookings or when its processes use more memory than this,
+# these are only checked by the warm-up. It's always restarted if it doesn't answer or after too many errors in a row.
+BROWSER_RECYCLE_BOOKINGS = int(config.get('BROWSER_RECYCLE_BOOKINGS', 500))
+BROWSER_MAX_RSS = int(config.get('BROWSER_MAX_RSS_MB', 1024)) * 1024 * 1024
+BROWSER_MAX_ERRORS = int(config.get('BROWSER_MAX_ERRORS', 3))
+BROWSER_PROBE_TIMEOUT = float(config.get('BROWSER_PROBE_TIMEOUT', 10))
+# Caps (in seconds) of the waits for a page load, for the login redirect and for the booking page elements
+PAGE_WAIT = float(config.get('BROWSER_PAGE_WAIT', 60))
+LOGIN_WAIT = float(config.get('BROWSER_LOGIN_WAIT', 10))
+STEP_WAIT = float(config.get('BROWSER_STEP_WAIT', 5))
+WAIT_POLL = float(config.get('BROWSER_WAIT_POLL', 0.05))
+# 'inline' prints the receipt right after each booking, 'deferred' prints them when the browser has no bookings to do
+RECEIPT_MODE = config.get('RECEIPT_MODE', 'inline')
 
 
 class LoginException(Exception):
@@ -28,9 +63,85 @@ class AlreadyBooked(Exception):
     pass
 
 
+@dataclass
+class BookTiming:
+    # {step: seconds}, in execution order
+    steps: dict[str, float] = field(default_factory=dict)
+    # [(step, start, end)] with time.monotonic() values
+    spans: list[tuple[str, float, float]] = field(default_factory=list)
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self.steps[name] = self.steps.get(name, 0.0) + end - start
+            self.spans.append((name, start, end))
+
+    @property
+    def total(self) -> float:
+        return sum(self.steps.values())
+
+    def __str__(self):
+        return ', '.join(f'{name} {x:.2f}s' for name, x in self.steps.items()) + f' (total {self.total:.2f}s)'
+
+
+@dataclass
+class BrowserHealth:
+    started: float = field(default_factory=time.monotonic)
+    bookings: int = 0
+    errors: int = 0
+    consecutive_errors: int = 0
+    # Memory of the driver and browser processes (None when it can't be read)
+    rss: Optional[int] = None
+
+    def __str__(self):
+        rss = f'{self.rss // (1024 * 1024)}MiB' if self.rss is not None else '?'
+        uptime = (time.monotonic() - self.started) / 3600
+        return f'rss {rss}, {self.bookings} bookings, {self.errors} errors, up {uptime:.1f}h'
+
+
+def _process_tree(root: int) -> list[int]:
+    children = {}  # type: dict[int, list[int]]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rt') as fd:
+                stat = fd.read()
+        except OSError:
+            continue
+        # The process name can contain spaces and parentheses
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    res, todo = [], [root]
+    while len(todo) > 0:
+        pid = todo.pop()
+        res.append(pid)
+        todo += children.get(pid, [])
+    return res
+
+
+class Receipt(NamedTuple):
+    """Page of a booking saved to be printed later"""
+    url: str
+    source: str
+
+
+def _with_base(source: str, url: str) -> str:
+    """Makes the relative links of the page source resolve against url"""
+    base = f'<base href="{url}">'
+    res, count = re.subn(r'<head(\s[^>]*)?>', lambda m: m.group(0) + base, source, count=1, flags=re.IGNORECASE)
+    return res if count > 0 else base + source
+
+
 class BrowserInteractor:
-    def __init__(self):
+    def __init__(self, store: SessionStore = sessions):
         self.current_user = None  # type: Optional[str]
+        self._store = store
 
         options = webdriver.FirefoxOptions()
         options.headless = True
@@ -38,41 +149,136 @@ class BrowserInteractor:
 
         self.driver = webdriver.Firefox(options=options, firefox_profile=profile)
         self.driver.set_page_load_timeout(30)
+        self.health = BrowserHealth()
+
+    def _wait(self, timeout: float) -> WebDriverWait:
+        return WebDriverWait(self.driver, timeout, poll_frequency=WAIT_POLL)
+
+    def _wait_booking_page(self):
+        self._wait(PAGE_WAIT).until(lambda d: d.current_url.startswith(LOGIN_URL) or
+                                    d.find_element_by_xpath('//a[contains(., "Le mie presenze di oggi")]'))
 
     def logout(self):
         self.driver.delete_all_cookies()
+        self.current_user = None
+
+    def _host(self) -> str:
+        return urlparse(self.driver.current_url).hostname or ''
+
+    def _restore_cookies(self, username: str) -> bool:
+        # The webdriver can only set the cookies of the domain currently open
+        host = self._host()
+        cookies = [x for x in self._store.get(username) if cookie_matches(x, host)]
+        for cookie in cookies:
+            self.driver.add_cookie(cookie)
+        return len(cookies) > 0
+
+    def _save_session(self):
+        host = self._host()
+        self._store.put(self.current_user, [x for x in self.driver.get_cookies() if cookie_matches(x, host)], host)
+
+    def _switch_user(self, username: str):
+        self.logout()
+        self._restore_cookies(username)
+        self.current_user = username
 
     def _handle_login(self, username: str, password: str):
         if not self.driver.current_url.startswith(LOGIN_URL):
             return
+        if self._restore_cookies(username):
+            # IdP session saved by the http backend, try to skip the login form
+            self.driver.get(self.driver.current_url)
+            self._wait_booking_page()
+            if not self.driver.current_url.startswith(LOGIN_URL):
+                self._save_session()
+                return
         self.driver.find_element_by_id('username').send_keys(username)
-        self.driver.find_element_by_id('password').send_keys(password)
+        password_field = self.driver.find_element_by_id('password')
+        password_field.send_keys(password)
         self.driver.find_element_by_css_selector('.content button[type="submit"]').click()
 
-        time.sleep(1.0)
+        # Done when we leave the IdP or when it shows the login form again (wrong credentials)
+        def login_done(d):
+            if not d.current_url.startswith(LOGIN_URL):
+                return True
+            return EC.staleness_of(password_field)(d) and len(d.find_elements_by_id('password')) > 0
+        try:
+            self._wait(LOGIN_WAIT).until(login_done)
+        except TimeoutException:
+            pass
 
         if self.driver.current_url.startswith(LOGIN_URL):
+            self._store.drop(username)
+            self.current_user = None
             raise LoginException('Login failed')
 
         self.current_user = username
+        self._save_session()
 
-    def book_one(self, username: str, password: str, url: str) -> Path:
-        if username != self.current_user:
-            self.logout()
-        self.driver.get(url)
+    def is_responsive(self, timeout: float = BROWSER_PROBE_TIMEOUT) -> bool:
+        # A wedged browser never answers, so the probe runs in another thread
+        answer = []
+        probe = threading.Thread(target=lambda: answer.append(self.driver.execute_script('return 1')), daemon=True)
+        probe.start()
+        probe.join(timeout)
+        return len(answer) > 0
+
+    def _pids(self) -> list[int]:
+        return _process_tree(self.driver.service.process.pid)
 
-        WebDriverWait(self.driver, 60).until(lambda d: d.current_url.startswith(LOGIN_URL) or
-                                             d.find_element_by_xpath('//a[contains(., "Le mie presenze di oggi")]'))
+    def update_health(self) -> BrowserHealth:
+        try:
+            page_size = os.sysconf('SC_PAGE_SIZE')
+            rss = 0
+            for pid in self._pids():
+                with open(f'/proc/{pid}/statm', 'rt') as fd:
+                    rss += int(fd.read().split()[1]) * page_size
+            self.health.rss = rss
+        except (OSError, ValueError, AttributeError):
+            self.health.rss = None
+        return self.health
+
+    def save_session(self):
+        if self.current_user is not None:
+            self._save_session()
+
+    def preload(self, url: str):
+        self.driver.get(url)
 
+    def login(self, username: str, password: str, url: str):
+        """Opens url logging in (or refreshing the saved session of) the user"""
+        if username != self.current_user:
+            self._switch_user(username)
+        self.driver.get(url)
+        self._wait_booking_page()
         self._handle_login(username, password)
 
-        time.sleep(0.1)
-        try:
-            submit_button = self.driver.find_element_by_xpath('//button[contains(., "Inserisci")]')
-            submit_button.click()
-            clicked = True
-        except Exception:
-            clicked = False
+    def book_one(self, username: str, password: str, url: str, timing: Optional[BookTiming] = None,
+                 defer_receipt: bool = False) -> Union[bytes, Receipt]:
+        timing = timing or BookTiming()
+        if username != self.current_user:
+            self._switch_user(username)
+        with timing.step('navigate'):
+            self.driver.get(url)
+            self._wait_booking_page()
+
+        with timing.step('login'):
+            self._handle_login(username, password)
+
+        with timing.step('click'):
+            try:
+                self._wait(STEP_WAIT).until(EC.any_of(
+                    EC.element_to_be_clickable((By.XPATH, '//button[contains(., "Inserisci")]')),
+                    EC.presence_of_element_located((By.XPATH, '//span[text() = "Attenzione"]'))
+                ))
+            except TimeoutException:
+                pass
+            try:
+                submit_button = self.driver.find_element_by_xpath('//button[contains(., "Inserisci")]')
+                submit_button.click()
+                clicked = True
+            except Exception:
+                clicked = False
 
         if not clicked:
             if self.driver.find_element_by_xpath(
@@ -85,12 +291,11 @@ class BrowserInteractor:
             raise Exception('Cannot find booking button (??)')
 
         # Wait for badge loading
-
-        elem = WebDriverWait(self.driver, 60)\
-                .until(EC.any_of(
+        with timing.step('badge'):
+            elem = self._wait(PAGE_WAIT).until(EC.any_of(
                 EC.visibility_of_element_located((By.XPATH, '//div[contains(text(), "Posto: ")]')),
                 EC.visibility_of_element_located((By.XPATH, '//div[contains(text(), "no permission")]'))
-                ))
+            ))
 
         text = elem.text
         if 'no permission' in text:
@@ -99,11 +304,37 @@ class BrowserInteractor:
             else:
                 raise Exception(text)
 
-        time.sleep(0.1)  # Don't know if it's necessary
+        if defer_receipt:
+            with timing.step('capture'):
+                return Receipt(self.driver.current_url, self.driver.page_source)
+
         # Print!
-        ret = self.driver.print_page()
+        with timing.step('print'):
+            try:
+                self._wait(STEP_WAIT).until(lambda d: d.execute_script('return document.readyState') == 'complete')
+            except TimeoutException:
+                pass
+            ret = self.driver.print_page()
         return base64.b64decode(ret)
 
+    def render_receipt(self, receipt: Receipt) -> bytes:
+        # Use another tab so the booking tab stays on the booking site (and its cookies can be swapped)
+        booking_tab = self.driver.current_window_handle
+        source = _with_base(receipt.source, receipt.url)
+        fd, path = tempfile.mkstemp(suffix='.html')
+        try:
+            with open(fd, 'wt', encoding='utf-8') as f:
+                f.write(source)
+            self.driver.switch_to.new_window('tab')
+            self.driver.get(Path(path).as_uri())
+            self._wait(STEP_WAIT).until(lambda d: d.execute_script('return document.readyState') == 'complete')
+            return base64.b64decode(self.driver.print_page())
+        finally:
+            if self.driver.current_window_handle != booking_tab:
+                self.driver.close()
+                self.driver.switch_to.window(booking_tab)
+            os.unlink(path)
+
     def save_debug_page(self):
         tstamp = int(time.time() * 1000)
         url = self.driver.current_url
@@ -118,6 +349,165 @@ class BrowserInteractor:
     def stop(self):
         self.driver.quit()
 
+    def kill(self):
+        """Kills the driver and the browser without talking to them, for when they don't answer"""
+        for pid in reversed(self._pids()):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class HttpInteractor:
+    """Books replaying the browser flow with plain HTTP requests (no javascript, no receipts)"""
+    def __init__(self, store: SessionStore = sessions):
+        self.current_user = None  # type: Optional[str]
+        self.session = requests.Session()
+        self._store = store
+        self._last_page = None  # type: Optional[requests.Response]
+
+    def logout(self):
+        self.session.cookies.clear()
+        self.current_user = None
+
+    def _save_session(self):
+        self._store.put(self.current_user, [{
+            'name': x.name,
+            'value': x.value,
+            'domain': x.domain,
+            'path': x.path,
+            'secure': x.secure,
+            'httpOnly': x.has_nonstandard_attr('HttpOnly'),
+            'expiry': x.expires,
+        } for x in self.session.cookies])
+
+    def _switch_user(self, username: str):
+        self.logout()
+        for x in self._store.get(username):
+            self.session.cookies.set(x['name'], x['value'], domain=x['domain'], path=x.get('path', '/'),
+                                     secure=x.get('secure', False), expires=x.get('expiry'))
+        self.current_user = username
+
+    def _get(self, url: str) -> requests.Response:
+        res = self.session.get(url, timeout=HTTP_TIMEOUT)
+        self._last_page = res
+        return res
+
+    def _submit(self, res: requests.Response, form: html.FormElement, extra: dict[str, str]) -> requests.Response:
+        data = dict(form.form_values())
+        data.update(extra)
+        action = urljoin(res.url, form.get('action') or res.url)
+        if (form.get('method') or 'get').lower() == 'post':
+            res = self.session.post(action, data=data, timeout=HTTP_TIMEOUT)
+        else:
+            res = self.session.get(action, params=data, timeout=HTTP_TIMEOUT)
+        self._last_page = res
+        return res
+
+    @staticmethod
+    def _parse(res: requests.Response) -> html.HtmlElement:
+        return html.fromstring(res.content, base_url=res.url)
+
+    @staticmethod
+    def _button_value(button: html.HtmlElement) -> dict[str, str]:
+        name = button.get('name')
+        return {name: button.get('value') or ''} if name else {}
+
+    def _handle_login(self, res: requests.Response, username: str, password: str) -> requests.Response:
+        if not res.url.startswith(LOGIN_URL):
+            return res
+        page = self._parse(res)
+        form = page.xpath('//form[.//input[@id="username"]]')
+        if len(form) == 0:
+            raise Exception('Cannot find login form')
+        form = form[0]
+        extra = {
+            form.xpath('.//input[@id="username"]')[0].get('name'): username,
+            form.xpath('.//input[@id="password"]')[0].get('name'): password,
+        }
+        submit = form.xpath('.//button[@type="submit"]')
+        if len(submit) > 0:
+            extra.update(self._button_value(submit[0]))
+        res = self._submit(res, form, extra)
+
+        # The SAML response is posted back to the service by javascript in a browser
+        for _ in range(5):
+            form = self._parse(res).xpath('//form[.//input[@name="SAMLResponse"]]')
+            if len(form) == 0:
+                break
+            res = self._submit(res, form[0], {})
+
+        if res.url.startswith(LOGIN_URL):
+            if len(self._parse(res).xpath('//input[@id="password"]')) > 0:
+                self._store.drop(username)
+                self.current_user = None
+                raise LoginException('Login failed')
+            raise Exception('Unexpected login page')
+
+        self.current_user = username
+        self._save_session()
+        return res
+
+    def is_responsive(self) -> bool:
+        return True
+
+    def preload(self, url: str):
+        self._get(url)
+
+    def login(self, username: str, password: str, url: str):
+        if username != self.current_user:
+            self._switch_user(username)
+        self._handle_login(self._get(url), username, password)
+
+    def book_one(self, username: str, password: str, url: str, timing: Optional[BookTiming] = None) -> Optional[bytes]:
+        timing = timing or BookTiming()
+        if username != self.current_user:
+            self._switch_user(username)
+        with timing.step('navigate'):
+            res = self._get(url)
+        with timing.step('login'):
+            res = self._handle_login(res, username, password)
+        page = self._parse(res)
+
+        button = page.xpath('//button[contains(., "Inserisci")]')
+        if len(button) == 0:
+            if len(page.xpath('//span[text() = "Attenzione"]/parent::*[contains(., "altre prenotazioni")]')) > 0:
+                raise AlreadyBooked()
+            if len(page.xpath(
+                    '//span[text() = "Attenzione"]/parent::*[contains(., "Non e\' possibile inserire la presenza")]'
+            )) > 0:
+                raise Exception('Cannot insert booking (??)')
+            raise Exception('Cannot find booking button (??)')
+        form = button[0].xpath('./ancestor::form')
+        if len(form) == 0:
+            raise Exception('Booking button is not in a form')
+        with timing.step('click'):
+            res = self._submit(res, form[0], self._button_value(button[0]))
+
+        with timing.step('badge'):
+            text = self._parse(res).text_content()
+        if 'no permission' in text:
+            if 'insert_multiple_time' in text:
+                raise AlreadyBooked()
+            raise Exception('Booking refused')
+        if 'Posto: ' not in text:
+            raise Exception('Cannot find booking confirmation')
+        return None
+
+    def save_debug_page(self):
+        if self._last_page is None:
+            return
+        tstamp = int(time.time() * 1000)
+        try:
+            with open(f'{tstamp}.html', 'wt') as fd:
+                fd.write(self._last_page.url + '\n' * 3)
+                fd.write(self._last_page.text)
+        except:
+            pass
+
+    def stop(self):
+        self.session.close()
+
 
 class BookResultType(Enum):
     OK = 1
@@ -136,6 +526,7 @@ class BookTurnResult(NamedTuple):
     info: BuildingTurn
     res: BookTurnResultType
     pdf: Optional[bytes]
+    timing: Optional[BookTiming] = None
 
 
 @dataclass
@@ -145,44 +536,185 @@ class BookResult:
     type: BookResultType
 
 
-class BrowserActor(pykka.ThreadingActor):
-    def __init__(self):
+class TurnAttempt(NamedTuple):
+    """Outcome of a single attempt to book a turn, error is set when result is missing"""
+    result: Optional[BookTurnResult]
+    error: Optional[BookResultType]
+    # Deferred receipts waiting on the worker for render_receipts
+    receipts: int = 0
+
+
+class BrowserActor(InstrumentedActor, pykka.ThreadingActor):
+    def __init__(self, backend: str = BOOKING_BACKEND, receipt_mode: str = RECEIPT_MODE):
         super().__init__()
-        self._browser = BrowserInteractor()
+        self._defer_receipts = receipt_mode == 'deferred'
+        # Receipts waiting to be printed: (turn result, receipt, on_receipt)
+        self._receipts = []  # type: list[tuple[BookTurnResult, Receipt, Optional[Callable]]]
+        self._http = HttpInteractor() if backend == 'http' else None
+        # With the http backend the browser is only started if it's needed as a fallback
+        self._browser = BrowserInteractor() if self._http is None else None  # type: Optional[BrowserInteractor]
+        # Last booking page, used by the warm-up when BOOKING_URL is not set
+        self._last_url = None  # type: Optional[str]
         self._logger = logging.getLogger('browser')
 
-    def process_bookings(self, username: str, password: str, turns: set[BuildingTurn]) -> BookResult:
-        turns = list(turns)
-        booked = []  # type: list[BookTurnResult]
-
-        for i, turn in enumerate(turns):
-            retry = 3
-            while retry > 0:
-                retry -= 1
-                try:
-                    self._logger.info(f"Booking {i}: {turn.room} {turn.trange} {turn.book_link}")
-                    data = self._browser.book_one(username, password, turn.book_link)
-                    booked.append(BookTurnResult(turn, BookTurnResultType.OK, data))
-                    retry = 0
-                except LoginException:
-                    self._logger.exception('Wrong login for user ' + username)
-                    return BookResult(booked, turns[i:], BookResultType.LOGIN_FAILED)
-                except TimeoutException:
-                    if retry > 0:
-                        self._logger.exception(f'Timeout, retries: {retry}')
-                    else:
-                        self._logger.exception(f'Timeout exception ({i}/{len(turns)})')
-                        return BookResult(booked, turns[i:], BookResultType.TIMEOUT)
-                except AlreadyBooked:
-                    self._logger.warning(f"Already booked ({i}/{len(turns)})")
-                    booked.append(BookTurnResult(turn, BookTurnResultType.ALREADY_BOOKED, None))
-                    retry = 0
-                except Exception:
-                    self._browser.save_debug_page()
-                    self._logger.exception(f'Unknown exception ({i}/{len(turns)})')
-                    return BookResult(booked, turns[i:], BookResultType.UNKNOWN_ERR)
+    def _book_one(self, username: str, password: str, url: str, timing: BookTiming) -> Union[bytes, Receipt, None]:
+        if self._http is not None:
+            try:
+                return self._http.book_one(username, password, url, timing)
+            except (LoginException, AlreadyBooked):
+                raise
+            except Exception:
+                self._http.save_debug_page()
+                self._logger.exception('HTTP booking failed, falling back to the browser')
+        if self._browser is None:
+            self._browser = BrowserInteractor()
+        elif self._browser.health.consecutive_errors >= BROWSER_MAX_ERRORS:
+            self._recycle_browser(f'{self._browser.health.consecutive_errors} errors in a row',
+                                  self._browser.is_responsive())
+
+        health = self._browser.health
+        try:
+            res = self._browser.book_one(username, password, url, timing, self._defer_receipts)
+        except (LoginException, AlreadyBooked):
+            health.consecutive_errors = 0
+            raise
+        except Exception:
+            health.errors += 1
+            health.consecutive_errors += 1
+            raise
+        health.bookings += 1
+        health.consecutive_errors = 0
+        return res
+
+    def _check_browser(self, thresholds: bool = True):
+        if self._browser is None:
+            return
+        if not self._browser.is_responsive():
+            self._recycle_browser('not responsive', responsive=False)
+            return
+        if not thresholds:
+            return
+        health = self._browser.update_health()
+        self._logger.info(f'Browser health: {health}')
+        if health.bookings >= BROWSER_RECYCLE_BOOKINGS:
+            self._recycle_browser(f'{health.bookings} bookings')
+        elif health.rss is not None and health.rss > BROWSER_MAX_RSS:
+            self._recycle_browser('too much memory used')
+
+    def _recycle_browser(self, reason: str, responsive: bool = True):
+        """Replaces the browser with a new one, the sessions are kept in the session store.
+
+        A browser known not to be responsive is killed straight away.
+        """
+        old = self._browser
+        self._logger.warning(f'Restarting the browser ({reason}), {old.health}')
+        try:
+            if responsive:
+                old.save_session()
+                old.stop()
+            else:
+                old.kill()
+        except Exception:
+            self._logger.exception('Error stopping the browser')
+        self._browser = BrowserInteractor()
+
+    def warm_up(self, users: list[tuple[str, str]]):
+        """Gets ready for the midnight bookings: checks the browser, loads the booking site and logs in the users.
+
+        Call through ask_forwarding with a timeout, no more users are logged in after its deadline.
+        """
+        self._check_browser()
 
-        return BookResult(booked, [], BookResultType.OK)
+        url = BOOKING_URL or self._last_url
+        if url is None:
+            self._logger.warning('No booking page known (set BOOKING_URL), skipping the preload and the logins')
+            return
+        deadline = current_deadline()
+        interactor = self._http or self._browser
+        start = time.monotonic()
+        try:
+            interactor.preload(urljoin(url, '/'))
+        except Exception:
+            self._logger.exception('Cannot preload the booking site')
+
+        expiring = set(sessions.expiring([x[0] for x in users], WARM_UP_SESSION_MARGIN))
+        logins = [x for x in users if x[0] in expiring]
+        done = 0
+        for username, password in logins:
+            if deadline is not None and time.monotonic() >= deadline:
+                self._logger.warning(f'Warm-up out of time, {len(logins) - done} users not logged in')
+                break
+            done += 1
+            try:
+                interactor.login(username, password, url)
+            except LoginException:
+                self._logger.warning(f'Wrong login for user {username}')
+            except Exception:
+                self._logger.exception(f'Cannot log in {username} during the warm-up')
+        self._logger.info(f'Warm-up done in {time.monotonic() - start:.2f}s ({done} logins)')
+
+    def book_turn(self, username: str, password: str, turn: BuildingTurn,
+                  on_receipt: Optional[Callable[[BookTurnResult], None]] = None) -> TurnAttempt:
+        """Makes a single attempt to book the turn, deferred receipts are sent to on_receipt when printed"""
+        return self._book_turn(username, password, turn, on_receipt)._replace(receipts=len(self._receipts))
+
+    def _book_turn(self, username: str, password: str, turn: BuildingTurn,
+                   on_receipt: Optional[Callable[[BookTurnResult], None]]) -> TurnAttempt:
+        self._check_browser(thresholds=False)
+        timing = BookTiming()
+        try:
+            self._logger.info(f"Booking {username}: {turn.room} {turn.trange} {turn.book_link}")
+            self._last_url = turn.book_link
+            try:
+                data = self._book_one(username, password, turn.book_link, timing)
+            finally:
+                for name, start, end in timing.spans:
+                    tracer.add('browser.' + name, start, end, user=username, turn=turn.room)
+            self._logger.info(f"Booked {username}: {timing}")
+        except LoginException:
+            self._logger.exception('Wrong login for user ' + username)
+            return TurnAttempt(None, BookResultType.LOGIN_FAILED)
+        except TimeoutException:
+            self._logger.exception(f'Timeout after: {timing}')
+            return TurnAttempt(None, BookResultType.TIMEOUT)
+        except AlreadyBooked:
+            self._logger.warning(f"Already booked {username}: {turn.room} {turn.trange}")
+            return TurnAttempt(BookTurnResult(turn, BookTurnResultType.ALREADY_BOOKED, None, timing), None)
+        except Exception:
+            if self._browser is not None:
+                # A hung driver would block the snapshot as well
+                if self._browser.is_responsive():
+                    self._browser.save_debug_page()
+                else:
+                    self._recycle_browser('not responsive', responsive=False)
+            self._logger.exception(f'Unknown exception booking {username}')
+            return TurnAttempt(None, BookResultType.UNKNOWN_ERR)
+
+        if isinstance(data, Receipt):
+            result = BookTurnResult(turn, BookTurnResultType.OK, None, timing)
+            self._receipts.append((result, data, on_receipt))
+        else:
+            result = BookTurnResult(turn, BookTurnResultType.OK, data, timing)
+        return TurnAttempt(result, None)
+
+    def render_receipts(self) -> int:
+        """Prints the oldest deferred receipt and returns how many are left.
+
+        The pool calls it only when it has no booking ready for this worker, one receipt at a time.
+        """
+        if len(self._receipts) == 0:
+            return 0
+        turn, receipt, on_receipt = self._receipts.pop(0)
+        try:
+            pdf = self._browser.render_receipt(receipt)
+            if on_receipt is not None:
+                on_receipt(turn._replace(pdf=pdf))
+        except Exception:
+            self._logger.exception(f'Cannot print the receipt of {turn.info.room} {turn.info.trange}')
+        return len(self._receipts)
 
     def on_stop(self) -> None:
-        self._browser.stop()
+        if self._http is not None:
+            self._http.stop()
+        if self._browser is not None:
+            self._browser.stop()
@@ -0,0 +1,313 @@
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Optional
+
+import pykka
+from pykka import ActorRef
+
+from actorutil.forward import Deferred, ask_forwarding, current_deadline
+from actorutil.metrics import InstrumentedActor
+from actorutil.scheduler import scheduler
+from building import BuildingTurn, CellLocation
+from config import config
+from runtrace import tracer
+from .browser import BookResult, BookResultType, BookTurnResult, BrowserActor, TurnAttempt
+
+BROWSER_WORKERS = int(config.get('BROWSER_WORKERS', 1))
+# Attempts for every turn, failed attempts are retried after BOOKING_BACKOFF seconds (doubled every time, jittered)
+BOOKING_ATTEMPTS = int(config.get('BOOKING_ATTEMPTS', 3))
+BOOKING_BACKOFF = float(config.get('BOOKING_BACKOFF', 2))
+# Failed turns are not retried this many seconds after being queued, or after the turn starts if earlier
+# (the first attempt is always made)
+BOOKING_DEADLINE = float(config.get('BOOKING_DEADLINE', 30 * 60))
+# When process_bookings is asked with a deadline, the turns still queued this many seconds before it are given up
+# so that the partial result reaches the caller in time
+BOOKING_REPLY_MARGIN = float(config.get('BOOKING_REPLY_MARGIN', 2 * 60))
+# Order of the bookings of all the users, see PRIORITIES
+BOOKING_PRIORITY = config.get('BOOKING_PRIORITY', 'fair')
+
+
+@dataclass
+class _UserJob:
+    username: str
+    password: str
+    reply: Deferred
+    on_receipt: Optional[Callable[[int, BookTurnResult], None]]
+    turns: int
+    booked: list[BookTurnResult] = field(default_factory=list)
+    remaining: list[BuildingTurn] = field(default_factory=list)
+    error: BookResultType = BookResultType.OK
+    # Turns given to a worker at least once
+    started: int = 0
+    # time.monotonic() value, the queued turns are given up after it
+    deadline: Optional[float] = None
+    # Run of the caller, see cancel_run
+    run: Optional[object] = None
+    # Scheduler entry of the dispatch at the deadline
+    wake: Optional[int] = None
+
+    @property
+    def done(self) -> bool:
+        return len(self.booked) + len(self.remaining) >= self.turns
+
+
+@dataclass
+class _TurnWork:
+    job: _UserJob
+    turn: BuildingTurn
+    # time.monotonic() values, no retries after the deadline
+    deadline: float
+    # Queue order
+    seq: int
+    queued: float
+    not_before: float = 0.0
+    attempts: int = 0
+    started: float = 0.0
+
+
+# A priority gives the sort key of a work item, lower keys are booked first.
+# Retries always go after the turns never tried and ties are broken by queue order.
+Priority = Callable[[_TurnWork], tuple]
+
+
+def _earliest(work: _TurnWork) -> tuple:
+    return (work.turn.trange.start,)
+
+
+def _fair(work: _TurnWork) -> tuple:
+    # Round robin: every user gets a turn before anyone gets another one
+    return (work.job.started,) + _earliest(work)
+
+
+PRIORITIES = {
+    'fifo': lambda work: (),
+    'earliest': _earliest,
+    'fair': _fair,
+}  # type: dict[str, Priority]
+
+
+def _turn_deadline(turn: BuildingTurn, now: float) -> float:
+    today = datetime.now()
+    start = today.replace(hour=turn.trange.start // 60, minute=turn.trange.start % 60, second=0, microsecond=0)
+    return min(now + BOOKING_DEADLINE, now + (start - today).total_seconds())
+
+
+class BrowserPoolActor(InstrumentedActor, pykka.ThreadingActor):
+    """Distributes the bookings between many BrowserActors.
+
+    Every turn is a separate work item, an idle worker takes the ready one with the best priority (preferring
+    the users it booked last, so their session is already open). Failed attempts are queued again behind the other
+    users' work with a jittered backoff until they run out of attempts or reach their deadline.
+    Deferred receipts are printed by a worker only when there is no booking ready for it.
+    Call process_bookings through ask_forwarding.
+    """
+    def __init__(self, size: int = BROWSER_WORKERS, priority: str = BOOKING_PRIORITY):
+        super().__init__()
+        if priority not in PRIORITIES:
+            raise Exception(f'Unknown booking priority: {priority}')
+        self._size = size
+        self._priority = PRIORITIES[priority]
+        self._workers = []  # type: list[ActorRef]
+        self._busy = []  # type: list[bool]
+        # Deferred receipts waiting on each worker
+        self._receipts = []  # type: list[int]
+        # {username: worker index}
+        self._affinity = {}  # type: dict[str, int]
+        self._queue = deque()  # type: deque[_TurnWork]
+        self._seq = 0
+        self._dispatch_queued = False
+        # Scheduled dispatch of the work waiting for its backoff
+        self._wake = None  # type: Optional[int]
+        self._logger = logging.getLogger('browserpool')
+
+    def on_start(self) -> None:
+        self._workers = [BrowserActor.start() for _ in range(self._size)]
+        self._busy = [False] * self._size
+        self._receipts = [0] * self._size
+
+    def on_stop(self) -> None:
+        if self._wake is not None:
+            scheduler.cancel(self._wake)
+        for worker in self._workers:
+            worker.stop(block=True)
+
+    def process_bookings(self, username: str, password: str, turns: set[BuildingTurn],
+                         on_receipt: Optional[Callable[[int, BookTurnResult], None]] = None,
+                         run: Optional[object] = None) -> Deferred:
+        """Books the turns, deferred receipts are sent to on_receipt(index in booked, turn result) when printed.
+
+        If the ask_forwarding call has a deadline, the turns not started BOOKING_REPLY_MARGIN seconds before it
+        are given up and the partial result is returned.
+        """
+        reply = Deferred()
+        job = _UserJob(username, password, reply, on_receipt, len(turns), run=run)
+        if job.done:
+            reply.resolve(BookResult([], [], BookResultType.OK))
+            return reply
+
+        now = time.monotonic()
+        limit = current_deadline()
+        if limit is not None:
+            job.deadline = limit - BOOKING_REPLY_MARGIN
+            job.wake = scheduler.call_at(job.deadline, lambda: self.actor_ref.proxy().dispatch())
+        for turn in turns:
+            self._queue.append(_TurnWork(job, turn, _turn_deadline(turn, now), self._seq, now))
+            self._seq += 1
+        self._logger.info(f"Queued {len(turns)} turns of {username} ({len(self._queue)} in queue)")
+        # Dispatch after the bookings of the other users already in the inbox, so they are all ordered together
+        if not self._dispatch_queued:
+            self._dispatch_queued = True
+            self.actor_ref.proxy().dispatch()
+        return reply
+
+    def cancel_run(self, run: object):
+        """Gives up the queued turns of the bookings made with run, the ones being booked are still completed"""
+        dropped = [x for x in self._queue if x.job.run == run]
+        for work in dropped:
+            self._queue.remove(work)
+            work.job.remaining.append(work.turn)
+            work.job.error = BookResultType.TIMEOUT
+            if work.job.done:
+                self._reply(work.job)
+        if len(dropped) > 0:
+            self._logger.warning(f"Cancelled {len(dropped)} queued turns of run {run}")
+
+    def _booking_order(self, users: list[tuple[str, str, list[CellLocation]]]) -> list[tuple[str, str]]:
+        """Orders the users as the priority would if their planned turns were queued now"""
+        keys = []
+        for seq, (username, password, planned) in enumerate(users):
+            job = _UserJob(username, password, Deferred(), None, len(planned))
+            turns = [BuildingTurn(x.room, x.trange, '') for x in planned]
+            # The users with nothing planned go last
+            key = min((self._priority(_TurnWork(job, x, 0, seq, 0)) for x in turns), default=None)
+            keys.append((key is None, key or (), seq))
+        return [users[seq][:2] for _, _, seq in sorted(keys)]
+
+    def warm_up(self, users: list[tuple[str, str, list[CellLocation]]], count: int):
+        """Warms up every worker with the first count users (username, password, planned turns) in booking order.
+
+        Each user is logged in by the worker that will likely book it, the deadline of the ask_forwarding call
+        is passed to the workers.
+        """
+        assigned = [[] for _ in range(self._size)]  # type: list[list[tuple[str, str]]]
+        for i, (username, password) in enumerate(self._booking_order(users)[:count]):
+            assigned[self._affinity.setdefault(username, i % self._size)].append((username, password))
+        for worker, worker_users in zip(self._workers, assigned):
+            ask_forwarding(worker, 'warm_up', worker_users,
+                           on_error=lambda exc_info: self._logger.warning('Worker warm-up not done in time'))
+
+    def _next_work(self, index: int, now: float) -> Optional[_TurnWork]:
+        ready = [x for x in self._queue if x.not_before <= now]
+        if len(ready) == 0:
+            return None
+        work = min(ready, key=lambda x: (x.attempts,) + self._priority(x) +
+                   (self._affinity.get(x.job.username) != index, x.seq))
+        self._queue.remove(work)
+        return work
+
+    def dispatch(self):
+        self._dispatch_queued = False
+        now = time.monotonic()
+        # Work of the callers that can't wait anymore
+        for work in [x for x in self._queue if x.job.deadline is not None and x.job.deadline <= now]:
+            self._queue.remove(work)
+            self._fail(work.job, [work.turn], BookResultType.TIMEOUT)
+            if work.job.done:
+                self._reply(work.job)
+        for index in range(self._size):
+            if self._busy[index]:
+                continue
+            work = self._next_work(index, now)
+            if work is not None:
+                self._start(index, work)
+            elif self._receipts[index] > 0:
+                self._render(index)
+
+        if self._wake is not None:
+            scheduler.cancel(self._wake)
+            self._wake = None
+        if len(self._queue) > 0 and not all(self._busy):
+            # Everything left is waiting for its backoff
+            self._wake = scheduler.call_at(min(x.not_before for x in self._queue),
+                                           lambda: self.actor_ref.proxy().dispatch())
+
+    def _start(self, index: int, work: _TurnWork):
+        self._busy[index] = True
+        self._affinity[work.job.username] = index
+        if work.attempts == 0:
+            work.job.started += 1
+        work.attempts += 1
+        work.started = time.monotonic()
+        tracer.add('queue_wait', max(work.queued, work.not_before), work.started,
+                   user=work.job.username, turn=work.turn.room)
+
+        def on_receipt(res: BookTurnResult):
+            self.actor_ref.proxy().on_receipt(work.job, res)
+
+        ask_forwarding(self._workers[index], 'book_turn', work.job.username, work.job.password, work.turn, on_receipt,
+                       then=lambda attempt: self.actor_ref.proxy().on_attempt(index, work, attempt),
+                       on_error=lambda exc_info: self.actor_ref.proxy().on_attempt(
+                           index, work, TurnAttempt(None, BookResultType.UNKNOWN_ERR)))
+
+    def _render(self, index: int):
+        self._busy[index] = True
+        ask_forwarding(self._workers[index], 'render_receipts',
+                       then=lambda left: self.actor_ref.proxy().on_rendered(index, left),
+                       on_error=lambda exc_info: self.actor_ref.proxy().on_rendered(index, 0))
+
+    def on_rendered(self, index: int, left: int):
+        self._busy[index] = False
+        self._receipts[index] = left
+        self.dispatch()
+
+    def on_attempt(self, index: int, work: _TurnWork, attempt: TurnAttempt):
+        self._busy[index] = False
+        self._receipts[index] = attempt.receipts
+        job = work.job
+        now = time.monotonic()
+        tracer.add('book_turn', work.started, now, user=job.username, turn=work.turn.room,
+                   ok=attempt.result is not None)
+
+        if attempt.result is not None:
+            job.booked.append(attempt.result)
+        elif attempt.error == BookResultType.LOGIN_FAILED:
+            # No turn of this user can be booked
+            dropped = [x for x in self._queue if x.job is job]
+            for x in dropped:
+                self._queue.remove(x)
+            self._fail(job, [work.turn] + [x.turn for x in dropped], attempt.error)
+        else:
+            delay = BOOKING_BACKOFF * 2 ** (work.attempts - 1) * random.uniform(0.5, 1.5)
+            deadline = work.deadline if job.deadline is None else min(work.deadline, job.deadline)
+            if work.attempts < BOOKING_ATTEMPTS and now + delay < deadline:
+                self._logger.info(f"Retrying {job.username} {work.turn.room} in {delay:.1f}s "
+                                  f"(attempt {work.attempts}/{BOOKING_ATTEMPTS})")
+                work.not_before = now + delay
+                self._queue.append(work)
+            else:
+                self._fail(job, [work.turn], attempt.error)
+
+        if job.done:
+            self._reply(job)
+        self.dispatch()
+
+    def _fail(self, job: _UserJob, turns: list[BuildingTurn], error: BookResultType):
+        self._logger.warning(f"Giving up {len(turns)} turns of {job.username}: {error.name}")
+        job.remaining += turns
+        if job.error == BookResultType.OK:
+            job.error = error
+
+    def _reply(self, job: _UserJob):
+        if job.wake is not None:
+            scheduler.cancel(job.wake)
+            job.wake = None
+        job.reply.resolve(BookResult(job.booked, job.remaining, job.error))
+
+    def on_receipt(self, job: _UserJob, res: BookTurnResult):
+        if job.on_receipt is not None:
+            index = next(i for i, x in enumerate(job.booked) if x.info == res.info)
+            job.on_receipt(index, res)
@@ -1,8 +1,8 @@
 import itertools
 import logging
 import os.path
-import pickle
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from typing import Optional
 from itertools import groupby
 
@@ -10,21 +10,42 @@ import pykka
 
 import building
 import timetable
+from actorutil.forward import current_deadline
+from actorutil.metrics import InstrumentedActor
+from fetch import fetcher
+from runtrace import tracer
+from timetable_store import TimetableStore
 
-TIMETABLE_FILENAME = os.path.join(os.getcwd(), 'timetable_cache.pkl')
+TIMETABLE_FILENAME = os.path.join(os.getcwd(), 'timetable_cache.sqlite')
 TIMETABLE_FORMAT = '%Y/%m/%d %H:%M'
 
+# Seconds left to the caller of resolve_links_batch after the polling of the buildings gives up
+RESOLVE_REPLY_MARGIN = 30
+
 DAY_NAMES = ['lunedì', 'martedì', 'mercoledì', 'giovedì', 'venerdì', 'sabato', 'domenica']
 
 
+@dataclass
+class BookingPlan:
+    day: date
+    # {telegram id: (lectures the plan was computed from, where to book them)}
+    users: dict[int, tuple[list[tuple[str, str]], list[building.CellLocation]]]
+
+
 # Manages the datetime table and the building table
-class DataTableActor(pykka.ThreadingActor):
+class DataTableActor(InstrumentedActor, pykka.ThreadingActor):
     def __init__(self):
         super().__init__()
 
         self._logger = logging.getLogger('datetable')
+        self._store = TimetableStore(TIMETABLE_FILENAME)
+        # The full timetable is only loaded from the store when needed
         self._timetable = None  # type: Optional[timetable.OrarioDocenti]
+        self._timetable_date = None  # type: Optional[datetime]
         self._teacher_subjects = None  # type: Optional[dict[str, set[str]]]
+        self._lecture_index = timetable.LectureIndex()
+        # Teachers already present in the lecture index, None if all of them are
+        self._indexed_teachers = None  # type: Optional[set[str]]
         self._last_timetable_update = datetime.fromtimestamp(0)
 
     def on_start(self) -> None:
@@ -32,19 +53,77 @@ class DataTableActor(pykka.ThreadingActor):
         self.fast_update_timetable()
 
     def resolve_links(self, lectures: list[tuple[str, str]]) -> set[building.BuildingTurn]:
+        return self.resolve_links_batch({0: lectures})[0]
+
+    def resolve_links_batch(self, lectures: dict[int, list[tuple[str, str]]],
+                            located: Optional[dict[int, list[building.CellLocation]]] = None
+                            ) -> dict[int, set[building.BuildingTurn]]:
+        """Resolves the links of today for many users at once.
+
+        lectures are the subjects of each user, located are users whose lectures have already been
+        located (see plan_bookings). Every distinct lecture and location is only resolved once.
+        When called through ask_forwarding with a timeout the buildings are not polled past its deadline.
+        """
+        users = dict(located) if located is not None else {}
+        if len(lectures) > 0:
+            with tracer.span('timetable.update'):
+                self.fast_update_timetable()
+            with tracer.span('timetable.locate'):
+                users.update(self._locate_lectures(datetime.now().date(), lectures))
+
+        locations = set(loc for x in users.values() for loc in x)
+        with tracer.span('buildings.prefetch'):
+            deadline = current_deadline()
+            if deadline is not None:
+                deadline -= RESOLVE_REPLY_MARGIN
+            failed = building.prefetch_buildings((x.edif for x in locations), deadline)
+        building.poll_fetcher.log_stats()
+        links = {}  # type: dict[building.CellLocation, Optional[building.BuildingTurn]]
+        for loc in locations:
+            if loc.edif in failed:
+                continue
+            links[loc] = building.resolve_location(loc)
+            if links[loc] is None:
+                self._logger.error(f"Cannot find lecture building: {loc}")
+
+        res = {tid: set(links[x] for x in locs if links.get(x) is not None) for tid, locs in users.items()}
+        self._logger.info(f"Links resolved: {len(locations)} locations for {len(users)} users")
+        return res
+
+    def plan_bookings(self, day: date, users: dict[int, list[tuple[str, str]]]) -> BookingPlan:
+        """Locates in advance the lectures that each user will need to book in the given day"""
         self.fast_update_timetable()
-        res = set()
+        located = self._locate_lectures(day, users)
+        plan = BookingPlan(day, {tid: (list(lectures), located[tid]) for tid, lectures in users.items()})
+        self._logger.info(f"Planned {sum(len(x[1]) for x in plan.users.values())} bookings for {day}")
+        return plan
+
+    def _locate_lectures(self, day: date, users: dict[int, list[tuple[str, str]]]
+                         ) -> dict[int, list[building.CellLocation]]:
+        dayname = DAY_NAMES[day.weekday()]
+        self._index_teachers(x[0] for lectures in users.values() for x in lectures)
+
+        # {(teacher, lecture name): locations}, shared by all the users following the lecture
+        found = {}  # type: dict[tuple[str, str], list[building.CellLocation]]
+        res = {}
+        for tid, lectures in users.items():
+            locs = []
+            for teacher, lname in lectures:
+                key = (timetable.normalize_teacher_name(teacher), lname.lower())
+                if key not in found:
+                    found[key] = self._locate_lecture(dayname, key)
+                locs.extend(found[key])
+            res[tid] = locs
+        return res
 
-        day = DAY_NAMES[datetime.now().weekday()]
-        cells = timetable.get_lectures(self._timetable, day, lectures)
-        for cell in cells:
-            bdata = building.get_link_from_fim_time_table(cell)
-            if bdata is None:
+    def _locate_lecture(self, dayname: str, lecture: tuple[str, str]) -> list[building.CellLocation]:
+        res = []
+        for cell in timetable.get_lectures(self._lecture_index, dayname, [lecture]):
+            loc = building.locate_cell(cell)
+            if loc is None:
                 self._logger.error(f"Cannot find lecture building: {cell}")
                 continue
-            res.add(bdata)
-
-        self._logger.info(f"Links resolved: {res}")
+            res.append(loc)
         return res
 
     def fast_update_timetable(self) -> None:
@@ -53,46 +132,72 @@ class DataTableActor(pykka.ThreadingActor):
             self.update_timetable()
 
     def update_timetable(self) -> None:
-        last_time = None
-        if self._timetable is not None:
-            last_time = self._timetable.date
-        res = timetable.update_docenti(last_time)
+        res = timetable.update_docenti(self._timetable_date, self._get_timetable)
         if res is not None:
             self._logger.info(f"Updated timetable to {res.date.strftime(TIMETABLE_FORMAT)}")
             self._timetable = res
-            self._update_teacher_subjects()
+            self._timetable_date = res.date
+            self._update_indexes()
             self._save_timetable()
+            fetcher.log_stats()
         else:
             self._logger.info("Time table up to date")
         self._last_timetable_update = datetime.now()
 
+    def _get_timetable(self) -> Optional[timetable.OrarioDocenti]:
+        if self._timetable is None and self._timetable_date is not None:
+            try:
+                self._timetable = self._store.load()
+            except Exception:
+                self._logger.exception('Failed to load timetable cache')
+        return self._timetable
+
+    def _index_teachers(self, teachers) -> None:
+        if self._indexed_teachers is None:
+            return
+        missing = set(timetable.normalize_teacher_name(x) for x in teachers) - self._indexed_teachers
+        if len(missing) == 0:
+            return
+        try:
+            self._lecture_index.add(self._store.load_teachers(missing))
+        except Exception:
+            self._logger.exception('Failed to load timetable cache')
+            return
+        self._indexed_teachers.update(missing)
+
+    def _update_indexes(self):
+        self._update_teacher_subjects()
+        self._lecture_index = timetable.LectureIndex(self._timetable)
+        self._indexed_teachers = None
+
     def _update_teacher_subjects(self):
         teach_subj = itertools.chain(*[((y.teacher, y.name) for y in x) for x in self._timetable.data.values()])
         res = {k: set(vi[1] for vi in v) for k, v in groupby(sorted(set(teach_subj)), lambda x: x[0])}
         self._teacher_subjects = res
 
     def _load_timetable(self) -> None:
-        loaded = False
+        meta = None
 
         try:
-            with open(TIMETABLE_FILENAME, 'rb') as fd:
-                self._timetable = pickle.load(fd)
-            self._update_teacher_subjects()
-            loaded = True
-        except FileNotFoundError:
-            self._logger.info('Time table cache not present')
+            meta = self._store.load_meta()
+            if meta is None:
+                self._logger.info('Time table cache not present')
         except Exception:
             self._logger.exception('Failed to load timetable cache')
 
-        if loaded:
-            self._logger.info(f"Loaded timetable {self._timetable.date.strftime(TIMETABLE_FORMAT)}")
+        if meta is not None:
+            self._timetable = None
+            self._timetable_date = meta.date
+            self._teacher_subjects = meta.teacher_subjects
+            self._lecture_index = timetable.LectureIndex()
+            self._indexed_teachers = set()
+            self._logger.info(f"Loaded timetable {meta.date.strftime(TIMETABLE_FORMAT)}")
         else:
             self.update_timetable()
 
     def _save_timetable(self) -> None:
         try:
-            with open(TIMETABLE_FILENAME, 'wb') as fd:
-                pickle.dump(self._timetable, fd)
+            self._store.save(self._timetable, self._teacher_subjects)
         except Exception:
             self._logger.exception('Failed to save timetable cache')
 
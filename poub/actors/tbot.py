@@ -9,13 +9,17 @@ from telegram.ext import Updater, CallbackContext, ConversationHandler, Dispatch
     Filters, DispatcherHandlerStop
 
 from actorutil.event import EventListener
+from actorutil.metrics import InstrumentedActor
+from runtrace import tracer
 from timetable import normalize_teacher_name
-from .browser import BookResult, BookResultType, BookTurnResultType
+from .browser import BookResult, BookResultType, BookTurnResult, BookTurnResultType
 from .userdb import User
 from config import config
 
 USER_WHITELIST = [int(x) for x in config['TELEGRAM_WHITELIST'].split(' ')]
 USER_WHITELIST_FILTER = Filters.user(USER_WHITELIST)
+# Users allowed to use the admin commands (/stats)
+ADMIN_IDS = [int(x) for x in config.get('TELEGRAM_ADMINS', '').split()]
 TOKEN = config['TELEGRAM_TOKEN']
 
 USERNAME_PATTERN = re.compile(r'^\d+$')
@@ -36,7 +40,7 @@ class LoginConversation(Enum):
     SEND_PASSWORD = 2
 
 
-class TelegramBotActor(EventListener, ThreadingActor):
+class TelegramBotActor(InstrumentedActor, EventListener, ThreadingActor):
     def __init__(self, dt_ref: ActorProxy, userdb_ref: ActorProxy, booker_ref: ActorProxy):
         super().__init__()
         self.dt_ref = dt_ref
@@ -44,6 +48,7 @@ class TelegramBotActor(EventListener, ThreadingActor):
         self.booker_ref = booker_ref
 
         self.event_subscribe(self.actor_ref, booker_ref.proxy().events, 'booked', self._on_booked)
+        self.event_subscribe(self.actor_ref, booker_ref.proxy().events, 'receipt', self._on_receipt)
         self.updater = Updater(token=TOKEN)
         self.bot = self.updater.bot  # type: telegram.Bot
 
@@ -67,14 +72,19 @@ class TelegramBotActor(EventListener, ThreadingActor):
 
     def _on_booked(self, user: User, res: BookResult):
         """Called when the BookActor has finished booking a user"""
+        with tracer.span('notify', user=user.username):
+            self._notify_booked(user, res)
+
+    def _notify_booked(self, user: User, res: BookResult):
         for index, turn in enumerate(res.booked):
-            if turn.res == BookTurnResultType.OK:
-                self.bot.send_document(
+            if turn.res == BookTurnResultType.OK and turn.pdf is None:
+                # Booked without a browser or receipt printed later (see _on_receipt)
+                self.bot.send_message(
                     user.tid,
-                    document=turn.pdf,
-                    filename=f'presenza{index + 1}.pdf',
-                    caption=f'{turn.info.room} {turn.info.trange}'
+                    f'{turn.info.room} {turn.info.trange} Booked'
                 )
+            elif turn.res == BookTurnResultType.OK:
+                self._on_receipt(user, index, turn)
             else:
                 self.bot.send_message(
                     user.tid,
@@ -93,6 +103,20 @@ class TelegramBotActor(EventListener, ThreadingActor):
                        '\n'.join(f'- {i.room} {i.trange} {i.book_link}' for i in res.remaining))
             self.bot.send_message(user.tid, message)
 
+    def _on_receipt(self, user: User, index: int, turn: BookTurnResult):
+        self.bot.send_document(
+            user.tid,
+            document=turn.pdf,
+            filename=f'presenza{index + 1}.pdf',
+            caption=f'{turn.info.room} {turn.info.trange}'
+        )
+
+    def _cmd_stats(self, update: Update, ctx: CallbackContext):
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        run = tracer.last_run()
+        update.effective_chat.send_message(run.summary() if run is not None else 'No booking run yet')
+
     def _cmd_login(self, update: Update, ctx: CallbackContext):
         update.message.chat.send_message('WARNING: the username and password will be STORED in the daemon pc ' +
                                          'please be sure to trust the host before you continue!\n' +
@@ -236,6 +260,7 @@ class TelegramBotActor(EventListener, ThreadingActor):
             fallbacks=[CommandHandler('cancel', self._on_cancel)],
         ))
         d.add_handler(CommandHandler('list', self._cmd_list))
+        d.add_handler(CommandHandler('stats', self._cmd_stats))
 
     def on_start(self) -> None:
         self.updater.start_polling()
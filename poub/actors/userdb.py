@@ -5,6 +5,8 @@ from typing import Optional
 
 import pykka
 
+from actorutil.metrics import InstrumentedActor
+
 USERS_FILE = 'users.json'
 
 
@@ -20,7 +22,7 @@ class UserNotFoundException(Exception):
     pass
 
 
-class UserDbActor(pykka.ThreadingActor):
+class UserDbActor(InstrumentedActor, pykka.ThreadingActor):
     def __init__(self):
         super().__init__()
         self._users_by_tid = {}  # type: dict[int, User]
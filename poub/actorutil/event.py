@@ -1,3 +1,4 @@
+import threading
 from typing import Callable, Optional
 
 from pykka import ActorRef
@@ -16,7 +17,13 @@ class EventEmitter:
 
         return data is not None and len(data[1]) != 0
 
-    def emit(self, event_name, *args, then: Optional[Callable] = None, **kwargs) -> None:
+    def emit(self, event_name, *args, then: Optional[Callable] = None, timeout: Optional[float] = None,
+             **kwargs) -> None:
+        """Sends the event to the listeners, then(results) is called when all of them have handled it.
+
+        results has the value returned by each listener, None for the ones that failed or that did not finish
+        within timeout seconds (then is called anyway with the partial results).
+        """
         data = self.__data.get(event_name, None)
         if data is None:
             return
@@ -24,16 +31,22 @@ class EventEmitter:
         eid, listeners = data
         argdata = (eid, args, kwargs)
         if then is not None:
+            lock = threading.Lock()
             remaining = len(listeners)
+            results = [None] * len(listeners)
 
-            def x_then(_info=None):
+            def x_then(index: int, value=None):
                 nonlocal remaining
-                remaining -= 1
-                if remaining == 0:
-                    then()
-
-            for listener in listeners:
-                ask_forwarding(listener, ('on_event',), *argdata, then=x_then, on_error=x_then)
+                with lock:
+                    results[index] = value
+                    remaining -= 1
+                    if remaining != 0:
+                        return
+                then(results)
+
+            for i, listener in enumerate(listeners):
+                ask_forwarding(listener, ('on_event',), *argdata, timeout=timeout,
+                               then=lambda value, i=i: x_then(i, value), on_error=lambda _info, i=i: x_then(i))
         else:
             for listener in listeners:
                 listener.tell(ProxyCall(('on_event',), argdata, {}))
@@ -62,7 +75,7 @@ class EventListener:
         callab = self._subscribed[eid]
         if callab is None:
             return
-        callab(*args, **kwargs)
+        return callab(*args, **kwargs)
 
     def event_subscribe(self, self_ref: ActorRef, emitter: EventEmitter, event_name: str, run: Callable):
         eid = emitter.on_subscribe(event_name, self_ref).get()
@@ -1,4 +1,8 @@
 import logging
+import queue
+import sys
+import threading
+import time
 from typing import Optional, Callable, Union
 
 from pykka import Future, ActorRef
@@ -6,28 +10,173 @@ from pykka import Future, ActorRef
 from pykka._envelope import Envelope
 from pykka.messages import ProxyCall
 
+from actorutil.scheduler import scheduler
+
+
+class Deferred:
+    """Reply of an actor method that will only be available later.
+
+    An actor method called through ask_forwarding can return a Deferred and complete it later
+    (even from another thread) with resolve or fail, the caller's then/on_error will be called then.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._future = None  # type: Optional[Future]
+        # (is_error, value) once completed
+        self._result = None  # type: Optional[tuple[bool, object]]
+
+    def _bind(self, future: Future):
+        with self._lock:
+            self._future = future
+            result = self._result
+        if result is not None:
+            self._deliver(future, result)
+
+    def _complete(self, result: tuple[bool, object]):
+        with self._lock:
+            if self._result is not None:
+                return
+            self._result = result
+            future = self._future
+        if future is not None:
+            self._deliver(future, result)
+
+    @staticmethod
+    def _deliver(future: Future, result: tuple[bool, object]):
+        if result[0]:
+            future.set_exception(result[1])
+        else:
+            future.set(result[1])
+
+    def resolve(self, value=None):
+        self._complete((False, value))
+
+    def fail(self, exc_info=None):
+        self._complete((True, exc_info))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
 
 class _ForwardingFuture(Future):
-    def __init__(self, then: Optional[Callable], on_error: Optional[Callable]):
+    """Calls then or on_error once: results arriving after the deadline or a cancel are dropped"""
+    def __init__(self, then: Optional[Callable], on_error: Optional[Callable], deadline: Optional[float] = None):
         self._then = then
         self._on_error = on_error
+        # time.monotonic() value
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._done = False
+        self._expiry = scheduler.call_at(deadline, self._expire) if deadline is not None else None
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def _finish(self) -> bool:
+        with self._lock:
+            if self._done:
+                return False
+            self._done = True
+        if self._expiry is not None:
+            scheduler.cancel(self._expiry)
+        return True
+
+    def _expire(self):
+        try:
+            raise DeadlineExceeded('Deadline exceeded')
+        except DeadlineExceeded:
+            self.set_exception(sys.exc_info())
+
+    def cancel(self):
+        self._finish()
 
     def set(self, value=None):
+        if isinstance(value, Deferred):
+            value._bind(self)
+            return
+        if not self._finish():
+            return
         if self._then is not None:
             self._then(value)
 
     def set_exception(self, exc_info=None):
+        if not self._finish():
+            return
         if self._on_error is not None:
             self._on_error(exc_info)
         else:
             logging.error('Error while futuring!', exc_info=exc_info)
 
 
+# The ask_forwarding message being handled by the current actor thread
+_context = threading.local()
+
+
+def current_deadline() -> Optional[float]:
+    """Deadline (time.monotonic() value) of the message being handled, None if it has none"""
+    future = getattr(_context, 'future', None)
+    return future.deadline if future is not None else None
+
+
+class ForwardingInbox(queue.Queue):
+    def _get(self):
+        envelope = super()._get()
+        reply_to = getattr(envelope, 'reply_to', None)
+        _context.future = reply_to if isinstance(reply_to, _ForwardingFuture) else None
+        return envelope
+
+
+class ForwardingActor:
+    """Mixin for pykka actors handling the deadlines of ask_forwarding.
+
+    Messages cancelled or expired while waiting in the inbox are dropped, while a message is handled its deadline
+    is returned by current_deadline() and inherited by the ask_forwarding calls made from the actor.
+    Must come before the pykka actor class: class MyActor(ForwardingActor, ThreadingActor)
+    """
+    @staticmethod
+    def _create_actor_inbox():
+        return ForwardingInbox()
+
+    def _handle_receive(self, message):
+        future = getattr(_context, 'future', None)
+        try:
+            if future is not None and future.done:
+                return None
+            return super()._handle_receive(message)
+        finally:
+            _context.future = None
+
+
+class ForwardingHandle:
+    def __init__(self, future: _ForwardingFuture):
+        self._future = future
+
+    @property
+    def deadline(self) -> Optional[float]:
+        return self._future.deadline
+
+    def cancel(self):
+        """Neither then nor on_error will be called, the message is dropped if the actor has not taken it yet"""
+        self._future.cancel()
+
+
 def ask_forwarding(actor_ref: ActorRef, path: Union[str, tuple], *args,
-                   then: Optional[Callable] = None, on_error: Optional[Callable] = None, **kwargs):
+                   then: Optional[Callable] = None, on_error: Optional[Callable] = None,
+                   timeout: Optional[float] = None, **kwargs) -> ForwardingHandle:
+    """Calls the actor method without blocking, its result is passed to then (or the error to on_error).
+
+    After timeout seconds on_error gets a DeadlineExceeded instead (called by the scheduler thread), the deadline
+    of the message being handled (if any) is inherited.
+    """
     if type(path) == str:
         path = (path,)
+    deadline = current_deadline()
+    if timeout is not None:
+        deadline = min(deadline, time.monotonic() + timeout) if deadline is not None else time.monotonic() + timeout
     message = ProxyCall(path, args, kwargs)
-    false_future = _ForwardingFuture(then, on_error)
+    false_future = _ForwardingFuture(then, on_error, deadline)
 
     actor_ref.actor_inbox.put(Envelope(message, reply_to=false_future))
+    return ForwardingHandle(false_future)
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import Optional
+
+from pykka.messages import ProxyCall, ProxyGetAttr, ProxySetAttr
+
+from actorutil.forward import ForwardingActor, ForwardingInbox
+
+
+class InstrumentedInbox(ForwardingInbox):
+    """Actor inbox remembering when each message was enqueued.
+
+    Every message goes through put (tell, ask, ask_forwarding, EventEmitter.emit), so the time it waited
+    is known when the actor gets it.
+    """
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._stamps = deque()  # type: deque[float]
+        # Seconds waited by the last message taken (only read by the actor thread)
+        self.last_wait = 0.0
+
+    def _put(self, item):
+        super()._put(item)
+        self._stamps.append(time.monotonic())
+
+    def _get(self):
+        self.last_wait = time.monotonic() - self._stamps.popleft()
+        return super()._get()
+
+
+@dataclass
+class MessageStats:
+    count: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    handle_total: float = 0.0
+    handle_max: float = 0.0
+    # Messages left in the inbox when one was taken
+    depth_max: int = 0
+
+
+def message_name(message) -> str:
+    if isinstance(message, (ProxyCall, ProxyGetAttr, ProxySetAttr)):
+        return '.'.join(message.attr_path)
+    return type(message).__name__
+
+
+class ActorMetrics:
+    """Message latency statistics per (actor, method), logged and reset every interval"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # type: dict[tuple[str, str], MessageStats]
+        self._timer = None  # type: Optional[threading.Timer]
+        self._logger = logging.getLogger('actormetrics')
+
+    def record(self, actor: str, method: str, wait: float, handle: float, depth: int):
+        with self._lock:
+            x = self._stats.get((actor, method))
+            if x is None:
+                x = self._stats[(actor, method)] = MessageStats()
+            x.count += 1
+            x.wait_total += wait
+            x.wait_max = max(x.wait_max, wait)
+            x.handle_total += handle
+            x.handle_max = max(x.handle_max, handle)
+            x.depth_max = max(x.depth_max, depth)
+
+    def snapshot(self, reset: bool = False) -> dict[tuple[str, str], MessageStats]:
+        with self._lock:
+            res = {k: replace(v) for k, v in self._stats.items()}
+            if reset:
+                self._stats.clear()
+        return res
+
+    def log(self):
+        stats = self.snapshot(reset=True)
+        # The slowest first
+        for (actor, method), x in sorted(stats.items(), key=lambda x: -(x[1].wait_total + x[1].handle_total)):
+            self._logger.info(f'{actor}.{method}: {x.count} msgs, wait avg {x.wait_total / x.count * 1000:.1f}ms '
+                              f'max {x.wait_max * 1000:.1f}ms, handle avg {x.handle_total / x.count * 1000:.1f}ms '
+                              f'max {x.handle_max * 1000:.1f}ms, inbox depth max {x.depth_max}')
+
+    def start_logging(self, interval: float):
+        def run():
+            self.log()
+            self.start_logging(interval)
+        self._timer = threading.Timer(interval, run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop_logging(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+metrics = ActorMetrics()
+
+
+class InstrumentedActor(ForwardingActor):
+    """Mixin for pykka actors, records in `metrics` how long every message waited in the inbox and was handled.
+
+    Also handles the ask_forwarding deadlines (see ForwardingActor).
+
+    Must come before the pykka actor class: class MyActor(InstrumentedActor, ThreadingActor)
+    """
+    @staticmethod
+    def _create_actor_inbox():
+        return InstrumentedInbox()
+
+    def _handle_receive(self, message):
+        inbox = self.actor_inbox  # type: InstrumentedInbox
+        wait, depth = inbox.last_wait, inbox.qsize()
+        start = time.monotonic()
+        try:
+            return super()._handle_receive(message)
+        finally:
+            metrics.record(type(self).__name__, message_name(message), wait, time.monotonic() - start, depth)
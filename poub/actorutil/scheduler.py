@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+
+class Scheduler:
+    """Calls functions at a given time.monotonic() instant, all from the same thread (so they must be quick)"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # type: list[tuple[float, int]]
+        # {entry: function} of the calls not done nor cancelled
+        self._pending = {}  # type: dict[int, Callable]
+        self._seq = itertools.count()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._logger = logging.getLogger('scheduler')
+
+    def call_at(self, when: float, fn: Callable) -> int:
+        """Returns the entry to pass to cancel"""
+        with self._cond:
+            entry = next(self._seq)
+            self._pending[entry] = fn
+            heapq.heappush(self._heap, (when, entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def call_later(self, delay: float, fn: Callable) -> int:
+        return self.call_at(time.monotonic() + delay, fn)
+
+    def cancel(self, entry: int):
+        with self._cond:
+            self._pending.pop(entry, None)
+
+    def _next(self) -> Callable:
+        with self._cond:
+            while True:
+                # Cancelled entries are removed lazily
+                while len(self._heap) > 0 and self._heap[0][1] not in self._pending:
+                    heapq.heappop(self._heap)
+                if len(self._heap) == 0:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait <= 0:
+                    return self._pending.pop(heapq.heappop(self._heap)[1])
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            fn = self._next()
+            try:
+                fn()
+            except Exception:
+                self._logger.exception('Error in scheduled call')
+
+
+scheduler = Scheduler()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Offline benchmarks for scraping, parsing and link resolution.
+
+Uses the pages saved in benchdata/ (scaled up to a realistic department size and 10x that)
+and prints the results as JSON, e.g.:
+$ python3 poub/benchmark.py --scale 1 10 --output bench.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Callable
+
+from bs4 import BeautifulSoup
+from lxml import html
+
+import building
+import timetable
+
+BENCH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchdata')
+# Number of teachers of the department at scale 1
+TEACHERS = 200
+# Number of bookable users at scale 1
+USERS = 100
+SUBJECTS_PER_USER = 5
+BUILDINGS = ['MO-17', 'MO-18']
+DAY = 'martedì'
+
+
+@dataclass
+class Fixtures:
+    # [(teacher, page)]
+    teachers: list[tuple[str, bytes]]
+    # {edif: page}
+    buildings: dict[str, str]
+
+
+def load_fixtures(scale: int) -> Fixtures:
+    pages = []
+    docenti = os.path.join(BENCH_DATA, 'docenti')
+    for name in sorted(os.listdir(docenti)):
+        with open(os.path.join(docenti, name), 'rb') as fd:
+            pages.append(fd.read())
+    teachers = [(f'teacher{i}', pages[i % len(pages)]) for i in range(TEACHERS * scale)]
+
+    buildings = {}
+    for edif in BUILDINGS:
+        with open(os.path.join(BENCH_DATA, f'aulexedificio-{edif}.html'), 'rt', encoding='utf-8') as fd:
+            page = fd.read()
+        # Add more rooms by duplicating the rows of the table with different names
+        rows = re.findall(r'<tr><td>.*</tr>', page)
+        extra = [re.sub(r'<td>([^<]*Aula[^<]*)</td>', rf'<td>\1-{k}</td>', row) for k in range(1, scale) for row in rows]
+        buildings[edif] = page.replace('</table>', '\n'.join(extra) + '</table>')
+
+    return Fixtures(teachers, buildings)
+
+
+def measure(name: str, scale: int, items: int, run: Callable[[object], None], setup: Callable[[], object],
+            repeat: int) -> dict:
+    # Timing and memory are measured on different runs, tracemalloc slows everything down
+    best = None
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        run(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    data = setup()
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'scale': scale,
+        'items': items,
+        'seconds': best,
+        'items_per_second': items / best if best > 0 else None,
+        'peak_memory_kib': peak // 1024,
+    }
+
+
+def _grid(page: bytes):
+    return html.fromstring(page).xpath('//table[contains(@class, "timegrid")]')[0]
+
+
+def run_benchmarks(scale: int, repeat: int) -> list[dict]:
+    fix = load_fixtures(scale)
+    res = []
+
+    grids = [_grid(page) for _, page in fix.teachers]
+    for parser in ['fast', 'xpath']:
+        def extract(parser=parser):
+            timetable.TABLE_PARSER = parser
+            for grid in grids:
+                timetable._extract_table(grid)
+        res.append(measure(f'extract_table[{parser}]', scale, len(grids), lambda _: extract(), lambda: None, repeat))
+    timetable.TABLE_PARSER = 'fast'
+
+    tables = [timetable._extract_table(grid) for grid in grids]
+    res.append(measure('join_table', scale, len(tables),
+                       lambda data: [timetable._join_table(x) for x in data],
+                       lambda: copy.deepcopy(tables), repeat))
+
+    pages = list(fix.buildings.values())
+    res.append(measure('building.parse_table[bs4]', scale, len(pages),
+                       lambda _: [building.parse_table(BeautifulSoup(x, features='lxml')) for x in pages],
+                       lambda: None, repeat))
+    res.append(measure('building.parse_table[lxml]', scale, len(pages),
+                       lambda _: [building.parse_table_lxml(x) for x in pages],
+                       lambda: None, repeat))
+
+    data = {}
+    for teacher, page in fix.teachers:
+        data.update(timetable._parse_teacher_page(teacher, page))
+    tab = timetable.OrarioDocenti(datetime.now(), data)
+    index = timetable.LectureIndex(tab)
+
+    rand = random.Random(42)
+    subjects = sorted(set((cell.teacher, cell.name) for cells in data.values() for cell in cells))
+    users = [rand.sample(subjects, SUBJECTS_PER_USER) for _ in range(USERS * scale)]
+    res.append(measure('get_lectures', scale, len(users),
+                       lambda _: [timetable.get_lectures(index, DAY, x) for x in users],
+                       lambda: None, repeat))
+
+    cells = [cell for x in users for cell in timetable.get_lectures(index, DAY, x)]
+    today = date.today()
+    presences = {edif: building.parse_table_lxml(page) for edif, page in fix.buildings.items()}
+
+    def setup_buildings():
+        building.clear_cache()
+        for edif, pres in presences.items():
+            building.CACHE.put(edif, building.BuildingIndex(pres), stamp=today)
+
+    res.append(measure('get_link_from_fim_time_table', scale, len(cells),
+                       lambda _: [building.get_link_from_fim_time_table(x) for x in cells],
+                       setup_buildings, repeat))
+    building.clear_cache()
+
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline poub benchmarks')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scale:
+        results += run_benchmarks(scale, args.repeat)
+
+    report = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'wt') as fd:
+            json.dump(report, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
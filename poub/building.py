@@ -1,15 +1,22 @@
+import bisect
+import itertools
 import logging
 import re
 import time
 import urllib.parse
 from dataclasses import dataclass
-from datetime import date
-from typing import Optional, NamedTuple, Tuple
+from datetime import date, datetime
+from typing import Iterable, Optional, NamedTuple
 
+import lxml.html
 import requests
 from bs4 import BeautifulSoup
 
 import timetable
+from cache import SingleFlightCache
+from config import config
+from fetch import Fetcher
+from runtrace import tracer
 from timeutils import TimeRange
 
 
@@ -26,7 +33,77 @@ class BuildingTurn(NamedTuple):
     book_link: str
 
 
-CACHE = {}  # type: dict[str, Tuple[date, list[EdifPresences]]]
+class CellLocation(NamedTuple):
+    edif: str
+    # Normalized room name
+    room_name: str
+    room: str
+    trange: TimeRange
+
+
+TURN_PREFIX = 'Turno Aula '
+TABLE_START_PATTERN = re.compile(r'<table[^>]*class="[^"]*\btabella-responsiva\b[^"]*"[^>]*>')
+# 'lxml' or 'bs4' (full BeautifulSoup tree, slower)
+BUILDING_PARSER = config.get('BUILDING_PARSER', 'lxml')
+
+
+class RoomTurns:
+    """Turns of a room sorted by start time, supports overlap queries with a single bisection"""
+    def __init__(self, turns: list[tuple[TimeRange, str]]):
+        self._turns = sorted(turns, key=lambda x: x[0].start)
+        # Max end time of the turns up to each index, non decreasing so it can be bisected
+        self._max_ends = list(itertools.accumulate((x[0].end for x in self._turns), max))
+
+    def find_overlapping(self, trange: TimeRange) -> Optional[tuple[TimeRange, str]]:
+        """Returns the first turn (by start time) overlapping with trange"""
+        # The first turn ending after trange starts, every turn before it ends too early
+        i = bisect.bisect_right(self._max_ends, trange.start)
+        if i < len(self._turns) and self._turns[i][0].overlaps(trange):
+            return self._turns[i]
+        return None
+
+
+class BuildingIndex:
+    def __init__(self, presences: list[EdifPresences]):
+        self.presences = presences
+        turns = {}  # type: dict[str, list[tuple[TimeRange, str]]]
+        for p in presences:
+            turns.setdefault(p.name, []).extend(p.turni)
+        # {normalized room name: turns}
+        self.rooms = {k: RoomTurns(v) for k, v in turns.items()}
+
+    def find_turn(self, room_name: str, trange: TimeRange) -> Optional[tuple[TimeRange, str]]:
+        room = self.rooms.get(room_name)
+        if room is None:
+            return None
+        return room.find_overlapping(trange)
+
+
+class PollTimeout(Exception):
+    pass
+
+
+# Presences by building, valid only for the day they are downloaded
+CACHE = SingleFlightCache(
+    max_size=int(config.get('BUILDING_CACHE_SIZE', 16)),
+    ttl=float(config.get('BUILDING_CACHE_TTL', 6 * 60 * 60)),
+)  # type: SingleFlightCache[str, BuildingIndex]
+
+MONTHS = ['Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio',
+          'Giugno', 'Luglio', 'Agosto', 'Settembre', 'Ottobre',
+          'Novembre', 'Dicembre']
+DATE_PATTERN = re.compile(r'\d{1,2} (?:' + '|'.join(MONTHS) + r') \d{4}')
+
+POLL_MIN_INTERVAL = 0.2
+POLL_MAX_INTERVAL = float(config.get('BUILDING_POLL_MAX_INTERVAL', 5))
+# Seconds before giving up waiting for the presences to be published
+POLL_DEADLINE = float(config.get('BUILDING_POLL_DEADLINE', 20 * 60))
+# Bytes downloaded after the date when only the head of the page is requested
+POLL_RANGE_MARGIN = 1024
+# Buildings polled at the same time, the polling has its own connections so it can't starve the other requests
+POLL_WORKERS = int(config.get('BUILDING_POLL_WORKERS', 4))
+
+poll_fetcher = Fetcher(POLL_WORKERS, POLL_WORKERS)
 
 
 def build_url(edif):
@@ -39,9 +116,13 @@ def normalize_name(name: str) -> str:
     return ' '.join(tokens)
 
 
-def parse_table(soup: BeautifulSoup) -> list[EdifPresences]:
-    TURN_PREFIX = 'Turno Aula '
+def parse_page(page: str) -> list[EdifPresences]:
+    if BUILDING_PARSER == 'bs4':
+        return parse_table(BeautifulSoup(page, features='lxml'))
+    return parse_table_lxml(page)
 
+
+def parse_table(soup: BeautifulSoup) -> list[EdifPresences]:
     tab = soup.find('table', {'class': 'tabella-responsiva'})
     res = []
     for row in tab.find_all('tr', recursive=False):
@@ -56,69 +137,184 @@ def parse_table(soup: BeautifulSoup) -> list[EdifPresences]:
     return res
 
 
-def _download_building(edif: str, today: date) -> list[EdifPresences]:
-    MONTHS = ['Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio',
-              'Giugno', 'Luglio', 'Agosto', 'Settembre', 'Ottobre',
-              'Novembre', 'Dicembre']
-    datestr = f'{today.day} {MONTHS[today.month - 1]} {today.year}'
+def parse_table_lxml(page: str) -> list[EdifPresences]:
+    """Same as parse_table but only parses the presences table, without building a BeautifulSoup tree"""
+    tab = None
+    start = TABLE_START_PATTERN.search(page)
+    if start is not None:
+        end = page.find('</table>', start.end())
+        # The table can be parsed alone only if it doesn't contain other tables
+        if end != -1 and page.find('<table', start.end(), end) == -1:
+            tab = lxml.html.fragment_fromstring(page[start.start():end + len('</table>')])
+    if tab is None:
+        tab = lxml.html.fromstring(page).find_class('tabella-responsiva')[0]
+
+    res = []
+    for row in tab:
+        if row.tag != 'tr':
+            continue
+        datas = list(row.iter('td'))
+        edif = datas[1].text_content()
+        name = normalize_name(datas[2].text_content())
+        turni = []
+        for x in datas[3].iter('a'):
+            text = x.text_content()
+            if text.startswith(TURN_PREFIX):
+                turni.append((TimeRange.parse(text.removeprefix(TURN_PREFIX)), x.get('href')))
+        res.append(EdifPresences(
+            edif, name, turni
+        ))
+    return res
+
+
+class BuildingPoller:
+    """Polls the presences page of a building until the one of today gets published.
+
+    Uses conditional requests and, once it has seen where the date is in the page, only downloads
+    the head of the page until the date changes. Polls fast around the publish time (midnight) and
+    backs off further away from it, raising PollTimeout after the deadline.
+    """
+    def __init__(self, edif: str, today: date, deadline: float = POLL_DEADLINE):
+        self.edif = edif
+        self.url = build_url(edif)
+        self.datestr = f'{today.day} {MONTHS[today.month - 1]} {today.year}'
+        self.publish_time = datetime.combine(today, datetime.min.time())
+        self.deadline = time.monotonic() + deadline
+
+        self._etag = None  # type: Optional[str]
+        self._last_modified = None  # type: Optional[str]
+        # Last byte to request while the page is not updated, None to download everything
+        self._range_end = None  # type: Optional[int]
 
-    while True:
-        retry = 0
+    def _get(self, headers: dict[str, str]) -> requests.Response:
         req = None
-        while retry < 3:
-            url = build_url(edif)
-            req = requests.get(url, timeout=120)
-            if req.status_code != 200:
-                logging.error("Failed to load for edif: " + edif + ": " + str(req))
-                retry += 1
+        for _ in range(3):
+            req = poll_fetcher.get(self.url, headers=headers, timeout=120)
+            if req.status_code == 416 and 'Range' in headers:
+                # Ranges not supported after all
+                self._range_end = None
+                headers = {k: v for k, v in headers.items() if k != 'Range'}
                 continue
-            break
-        if req.status_code != 200:
-            raise Exception('Error contacting site')
-        html = req.text
-        if datestr in html:
-            break
-        else:
-            time.sleep(0.2)
+            if req.status_code not in (200, 206, 304):
+                logging.error("Failed to load for edif: " + self.edif + ": " + str(req))
+                continue
+            return req
+        raise Exception('Error contacting site')
+
+    def poll(self) -> Optional[str]:
+        """Returns the full page if it has been published, None otherwise"""
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+        if self._range_end is not None:
+            headers['Range'] = f'bytes=0-{self._range_end}'
+
+        req = self._get(headers)
+        if req.status_code == 304:
+            return None
+        self._etag = req.headers.get('ETag')
+        self._last_modified = req.headers.get('Last-Modified')
+
+        text = req.text
+        if self.datestr not in text:
+            if req.status_code == 200:
+                match = DATE_PATTERN.search(text)
+                self._range_end = match.end() + POLL_RANGE_MARGIN if match is not None else None
+            return None
+        if req.status_code == 206:
+            text = self._get({}).text
+            if self.datestr not in text:
+                return None
+        return text
+
+    def _interval(self) -> float:
+        now = datetime.now()
+        distance = abs((now - self.publish_time).total_seconds())
+        interval = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, distance / 30))
+        if now < self.publish_time:
+            interval = min(interval, (self.publish_time - now).total_seconds())
+        return max(interval, 0)
+
+    def run(self) -> str:
+        while True:
+            page = self.poll()
+            if page is not None:
+                return page
+            wait = self._interval()
+            if time.monotonic() + wait > self.deadline:
+                raise PollTimeout(f'Presences of {self.edif} not published for {self.datestr}')
+            time.sleep(wait)
 
-    return parse_table(BeautifulSoup(html, features='lxml'))
 
+def _download_building(edif: str, today: date, deadline: Optional[float] = None) -> BuildingIndex:
+    timeout = POLL_DEADLINE if deadline is None else min(POLL_DEADLINE, deadline - time.monotonic())
+    with tracer.span('building.poll', turn=edif):
+        html = BuildingPoller(edif, today, timeout).run()
+    with tracer.span('building.parse', turn=edif):
+        return BuildingIndex(parse_page(html))
 
-def get_presences_from_building(edif: str) -> list[EdifPresences]:
+
+def get_presences_from_building(edif: str, deadline: Optional[float] = None) -> BuildingIndex:
+    """deadline (time.monotonic() value) shortens the polling, if the presences are not published yet"""
     today = date.today()
-    if edif not in CACHE or CACHE[edif][0] != today:
-        CACHE[edif] = (today, _download_building(edif, today))
-    return CACHE[edif][1]
+    return CACHE.get(edif, lambda: _download_building(edif, today, deadline), stamp=today)
 
 
-def get_link_from_fim_time_table(cell: timetable.TableCell) -> Optional[BuildingTurn]:
+def prefetch_buildings(edifs: Iterable[str], deadline: Optional[float] = None) -> set[str]:
+    """Downloads (polling them in parallel) the presences of all the buildings, returns the ones that failed"""
+    def fetch(edif: str) -> bool:
+        try:
+            get_presences_from_building(edif, deadline)
+            return True
+        except Exception:
+            logging.exception(f"Cannot download presences of {edif}")
+            return False
+
+    edifs = list(set(edifs))
+    return set(edif for edif, ok in zip(edifs, poll_fetcher.starmap(fetch, [(x,) for x in edifs])) if not ok)
+
+
+def get_cell_building(cell: timetable.TableCell) -> Optional[str]:
     edif = re.search(r'[A-Z][0-9.]+[A-Za-z]*', cell.room).group(0)
     edif_char = edif[0]
 
     if edif_char == 'M':
         # Math
-        edif = 'MO-18'
+        return 'MO-18'
     elif edif_char == 'L':
         # Physics
-        edif = 'MO-17'
+        return 'MO-17'
     else:
         return None
 
-    pres = get_presences_from_building(edif)
 
-    room_name = normalize_name(cell.room)
+def locate_cell(cell: timetable.TableCell) -> Optional[CellLocation]:
+    """Computes everything needed to find the booking turn of a cell except the building presences"""
+    edif = get_cell_building(cell)
+    if edif is None:
+        return None
+    return CellLocation(edif, normalize_name(cell.room), cell.room, cell.trange)
 
-    for p in pres:
-        if p.name != room_name:
-            continue
-        for (orario, link) in p.turni:
-            if cell.trange.overlaps(orario):
-                return BuildingTurn(cell.room, orario, link)
 
-    return None
+def resolve_location(loc: CellLocation) -> Optional[BuildingTurn]:
+    pres = get_presences_from_building(loc.edif)
+
+    turn = pres.find_turn(loc.room_name, loc.trange)
+    if turn is None:
+        return None
+    orario, link = turn
+    return BuildingTurn(loc.room, orario, link)
+
+
+def get_link_from_fim_time_table(cell: timetable.TableCell) -> Optional[BuildingTurn]:
+    loc = locate_cell(cell)
+    if loc is None:
+        return None
+    return resolve_location(loc)
 
 
 def clear_cache():
-    global CACHE
-    CACHE = {}
+    CACHE.clear()
 
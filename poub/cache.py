@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Callers that waited for a load already in flight
+    waits: int = 0
+    evictions: int = 0
+
+
+class _Entry(Generic[V]):
+    def __init__(self, value: V, stamp: object, expires: Optional[float]):
+        self.value = value
+        self.stamp = stamp
+        self.expires = expires
+
+
+class _Flight:
+    def __init__(self, stamp: object):
+        self.stamp = stamp
+        self.done = threading.Event()
+        self.value = None
+        self.error = None  # type: Optional[BaseException]
+
+
+class SingleFlightCache(Generic[K, V]):
+    """Thread safe LRU cache where concurrent loads of the same key share a single in-flight load.
+
+    An entry is valid until its TTL expires and only for the stamp (e.g. the date) it was loaded with.
+    """
+    def __init__(self, max_size: int = 64, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: OrderedDict[K, _Entry[V]]
+        self._flights = {}  # type: dict[K, _Flight]
+        self._stats = CacheStats()
+
+    def _valid(self, entry: _Entry[V], stamp: object) -> bool:
+        return entry.stamp == stamp and (entry.expires is None or entry.expires > time.monotonic())
+
+    def get(self, key: K, load: Callable[[], V], stamp: object = None) -> V:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._valid(entry, stamp):
+                self._entries.move_to_end(key)
+                self._stats.hits += 1
+                return entry.value
+
+            flight = self._flights.get(key)
+            owner = flight is None or flight.stamp != stamp
+            if owner:
+                flight = _Flight(stamp)
+                self._flights[key] = flight
+                self._stats.misses += 1
+            else:
+                self._stats.waits += 1
+
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = load()
+            self.put(key, flight.value, stamp)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def put(self, key: K, value: V, stamp: object = None) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = _Entry(value, stamp, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return replace(self._stats)
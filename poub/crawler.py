@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from typing import Mapping, NamedTuple, Optional
+
+import aiohttp
+
+from config import config
+
+CRAWL_CONCURRENCY = int(config.get('CRAWL_CONCURRENCY', 32))
+CRAWL_TIMEOUT = float(config.get('CRAWL_TIMEOUT', 60))
+
+
+class CrawlResult(NamedTuple):
+    status: int
+    headers: Mapping[str, str]
+    content: bytes
+
+
+class Crawler:
+    """Downloads many pages concurrently from a single thread using asyncio.
+
+    Every request has its own timeout, the first failure cancels the remaining requests.
+    A running crawl can be cancelled from another thread using cancel().
+    """
+    def __init__(self, concurrency: int = CRAWL_CONCURRENCY, timeout: float = CRAWL_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._task = None  # type: Optional[asyncio.Task]
+        self._cancelled = False
+
+    def run(self, reqs: list[tuple[str, dict[str, str]]]) -> list[CrawlResult]:
+        """Fetches every (url, headers) request, results are in the same order of the requests.
+
+        Raises asyncio.CancelledError if the crawl gets cancelled.
+        """
+        return asyncio.run(self._run(reqs))
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._task is not None:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+
+    async def _run(self, reqs: list[tuple[str, dict[str, str]]]) -> list[CrawlResult]:
+        with self._lock:
+            if self._cancelled:
+                raise asyncio.CancelledError()
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.current_task()
+        try:
+            return await self._crawl(reqs)
+        finally:
+            with self._lock:
+                self._loop, self._task = None, None
+
+    async def _crawl(self, reqs: list[tuple[str, dict[str, str]]]) -> list[CrawlResult]:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def fetch(url: str, headers: dict[str, str]) -> CrawlResult:
+                async with sem:
+                    async with session.get(url, headers=headers) as resp:
+                        return CrawlResult(resp.status, resp.headers, await resp.read())
+
+            tasks = [asyncio.create_task(fetch(url, headers)) for url, headers in reqs]
+            try:
+                return await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
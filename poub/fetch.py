@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Callable, Iterable, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import config
+
+FETCH_WORKERS = int(config.get('FETCH_WORKERS', 8))
+FETCH_HOST_LIMIT = int(config.get('FETCH_HOST_LIMIT', 8))
+FETCH_TIMEOUT = float(config.get('FETCH_TIMEOUT', 60))
+
+
+@dataclass
+class HostStats:
+    requests: int = 0
+    errors: int = 0
+    bytes: int = 0
+    # Seconds
+    latency: float = 0.0
+    max_latency: float = 0.0
+
+
+class Fetcher:
+    """Shared HTTP session with keep-alive, a bounded number of requests per host and a worker pool"""
+    def __init__(self, workers: int = FETCH_WORKERS, host_limit: int = FETCH_HOST_LIMIT):
+        self._workers = workers
+        self._host_limit = host_limit
+        self._lock = threading.Lock()
+        self._session = None  # type: Optional[requests.Session]
+        self._pool = None  # type: Optional[ThreadPoolExecutor]
+        self._host_slots = {}  # type: dict[str, threading.BoundedSemaphore]
+        self._stats = {}  # type: dict[str, HostStats]
+
+        self._logger = logging.getLogger('fetch')
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self._workers, pool_maxsize=self._host_limit)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix='fetch')
+            return self._pool
+
+    def _get_slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self._host_limit)
+                self._host_slots[host] = slot
+            return slot
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', FETCH_TIMEOUT)
+        session = self._get_session()
+        host = urlsplit(url).netloc
+
+        with self._get_slot(host):
+            start = time.monotonic()
+            try:
+                res = session.get(url, **kwargs)
+                size = len(res.content)
+            except Exception:
+                self._account(host, time.monotonic() - start, 0, True)
+                raise
+        self._account(host, time.monotonic() - start, size, False)
+        return res
+
+    def starmap(self, fn: Callable, args: Iterable[tuple]) -> list:
+        pool = self._get_pool()
+        return list(pool.map(lambda x: fn(*x), args))
+
+    def _account(self, host: str, latency: float, size: int, error: bool):
+        with self._lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = HostStats()
+                self._stats[host] = stats
+            stats.requests += 1
+            stats.errors += int(error)
+            stats.bytes += size
+            stats.latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+    def stats(self) -> dict[str, HostStats]:
+        with self._lock:
+            return {k: replace(v) for k, v in self._stats.items()}
+
+    def log_stats(self):
+        for host, s in self.stats().items():
+            avg = s.latency / s.requests if s.requests > 0 else 0
+            self._logger.info(f"{host}: {s.requests} requests ({s.errors} errors), {s.bytes // 1024} KiB, "
+                              f"latency avg {avg * 1000:.0f}ms max {s.max_latency * 1000:.0f}ms")
+
+    def close(self):
+        with self._lock:
+            pool, session = self._pool, self._session
+            self._pool, self._session = None, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if session is not None:
+            session.close()
+
+
+fetcher = Fetcher()
@@ -5,17 +5,24 @@ import logging
 import pykka
 
 from actors.bookactor import BookActor
-from actors.browser import BrowserActor
+from actors.browserpool import BrowserPoolActor
 from actors.dtactor import DataTableActor
 from actors.tbot import TelegramBotActor
 from actors.userdb import UserDbActor
+from actorutil.metrics import metrics
+from building import poll_fetcher
+from config import config
+from fetch import fetcher
 from waiter import waiter
 
+# Seconds between the logs of the actor message latencies (0 to disable)
+ACTOR_METRICS_INTERVAL = float(config.get('ACTOR_METRICS_INTERVAL', 60))
+
 logging.basicConfig(level=logging.INFO)
 
 userdb = UserDbActor.start()
 dtactor = DataTableActor.start()
-browser = BrowserActor.start()
+browser = BrowserPoolActor.start()
 booker = BookActor.start(dtactor, browser, userdb)
 tbot = TelegramBotActor.start(dtactor, userdb, booker)
 
@@ -28,10 +35,15 @@ def shutdown_actors():
     reg = pykka.ActorRegistry()
     for act in reg.get_all():
         act.stop(block=True)
+    fetcher.close()
+    poll_fetcher.close()
+    metrics.stop_logging()
 
 
 def main():
     logging.info("Poub started, waiting until midnight")
+    if ACTOR_METRICS_INTERVAL > 0:
+        metrics.start_logging(ACTOR_METRICS_INTERVAL)
     # Used to test:
     # booker.proxy().book()
     try:
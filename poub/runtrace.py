@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Iterator, Optional
+
+from config import config
+
+# Directory where the report of every run is written
+TRACE_DIR = config.get('TRACE_DIR', 'traces')
+
+
+@dataclass
+class Span:
+    stage: str
+    # time.monotonic() values
+    start: float
+    end: float
+    user: Optional[str] = None
+    turn: Optional[str] = None
+    ok: bool = True
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+class RunTrace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        self.date = datetime.now()
+        self.finished = None  # type: Optional[float]
+        self._lock = threading.Lock()
+        self._spans = []  # type: list[Span]
+
+    def add(self, span: Span):
+        with self._lock:
+            self._spans.append(span)
+
+    def stages(self) -> dict[str, dict]:
+        with self._lock:
+            spans = list(self._spans)
+        durations = {}  # type: dict[str, list[float]]
+        errors = {}  # type: dict[str, int]
+        for x in spans:
+            durations.setdefault(x.stage, []).append(x.end - x.start)
+            errors[x.stage] = errors.get(x.stage, 0) + (not x.ok)
+        res = {}
+        for stage, values in durations.items():
+            values.sort()
+            res[stage] = {
+                'count': len(values),
+                'errors': errors[stage],
+                'total': sum(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1],
+            }
+        return res
+
+    def report(self) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        with self._lock:
+            spans = [dict(asdict(x), start=x.start - self.started, end=x.end - self.started) for x in self._spans]
+        return {
+            'name': self.name,
+            'date': self.date.isoformat(timespec='seconds'),
+            'duration': end - self.started,
+            'stages': self.stages(),
+            'spans': spans,
+        }
+
+    def summary(self) -> str:
+        end = self.finished if self.finished is not None else time.monotonic()
+        lines = [f'Run {self.name} of {self.date:%Y-%m-%d %H:%M:%S}, {end - self.started:.1f}s'
+                 + ('' if self.finished is not None else ' (running)')]
+        for stage, x in sorted(self.stages().items(), key=lambda x: -x[1]['total']):
+            lines.append(f"{stage}: {x['count']}x p50 {x['p50']:.2f}s p95 {x['p95']:.2f}s max {x['max']:.2f}s"
+                         + (f" ({x['errors']} errors)" if x['errors'] > 0 else ''))
+        return '\n'.join(lines)
+
+
+class Tracer:
+    """Collects the spans of the current run from every actor, spans outside of a run are ignored"""
+    def __init__(self, directory: str = TRACE_DIR):
+        self.directory = directory
+        self._current = None  # type: Optional[RunTrace]
+        self._last = None  # type: Optional[RunTrace]
+        self._logger = logging.getLogger('runtrace')
+
+    def start_run(self, name: str) -> RunTrace:
+        run = RunTrace(name)
+        self._current = run
+        return run
+
+    def finish_run(self):
+        run = self._current
+        if run is None:
+            return
+        self._current = None
+        run.finished = time.monotonic()
+        self._last = run
+        self._logger.info(run.summary())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{run.name}-{run.date:%Y%m%d-%H%M%S}.json')
+            with open(path, 'wt') as fd:
+                json.dump(run.report(), fd, indent=2)
+        except Exception:
+            self._logger.exception('Error saving the run trace')
+
+    def last_run(self) -> Optional[RunTrace]:
+        """The current run if there is one, otherwise the last finished one"""
+        return self._current or self._last
+
+    def add(self, stage: str, start: float, end: Optional[float] = None, user: Optional[str] = None,
+            turn: Optional[str] = None, ok: bool = True):
+        run = self._current
+        if run is not None:
+            run.add(Span(stage, start, end if end is not None else time.monotonic(), user, turn, ok))
+
+    @contextmanager
+    def span(self, stage: str, user: Optional[str] = None, turn: Optional[str] = None) -> Iterator[None]:
+        start = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.add(stage, start, user=user, turn=turn, ok=ok)
+
+
+tracer = Tracer()
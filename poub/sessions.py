@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from config import config
+
+SESSIONS_FILE = 'sessions.json'
+# Sessions older than this are considered expired even if their cookies are not
+SESSION_TTL = float(config.get('SESSION_TTL', 8 * 60 * 60))
+
+
+@dataclass
+class Session:
+    # Cookies in the webdriver format (name, value, domain, path, secure, httpOnly, expiry)
+    cookies: list[dict]
+    saved: float
+    expires: float
+
+
+def cookie_matches(cookie: dict, host: str) -> bool:
+    domain = (cookie.get('domain') or '').lstrip('.')
+    return host == domain or host.endswith('.' + domain)
+
+
+class SessionStore:
+    """Persistent cookie jars of the logged users, shared by every browser worker.
+
+    Restoring the cookies of a user skips the IdP login as long as the session is still valid on the server.
+    """
+    def __init__(self, path: str, ttl: float = SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._sessions = None  # type: Optional[dict[str, Session]]
+        self._logger = logging.getLogger('sessions')
+
+    def get(self, username: str) -> list[dict]:
+        """Returns the saved cookies of the user, or an empty list if the session is missing or expired"""
+        with self._lock:
+            session = self._load().get(username)
+            if session is None or session.expires <= time.time():
+                return []
+            return list(session.cookies)
+
+    def put(self, username: str, cookies: list[dict], host: Optional[str] = None):
+        """Saves the cookies of the user, if host is present only the cookies of that host are replaced"""
+        now = time.time()
+        with self._lock:
+            sessions = self._load()
+            old = sessions.get(username)
+            if host is not None and old is not None and old.expires > now:
+                cookies = [x for x in old.cookies if not cookie_matches(x, host)] + cookies
+            expires = min([now + self.ttl] + [x['expiry'] for x in cookies if x.get('expiry') is not None])
+            sessions[username] = Session(cookies, now, expires)
+            self._save()
+
+    def drop(self, username: str):
+        with self._lock:
+            if self._load().pop(username, None) is not None:
+                self._save()
+
+    def expiring(self, usernames: list[str], within: float) -> list[str]:
+        """Users (in the same order) whose session is missing or expires in the next `within` seconds"""
+        limit = time.time() + within
+        with self._lock:
+            sessions = self._load()
+            return [x for x in usernames if x not in sessions or sessions[x].expires <= limit]
+
+    def _load(self) -> dict[str, Session]:
+        if self._sessions is not None:
+            return self._sessions
+        self._sessions = {}
+        try:
+            with open(self.path, 'rt') as fd:
+                data = json.load(fd)
+            now = time.time()
+            self._sessions = {name: x for name, x in ((name, Session(**x)) for name, x in data.items())
+                              if x.expires > now}
+        except FileNotFoundError:
+            self._logger.info('session store not present')
+        except Exception:
+            self._logger.exception('Error loading session store')
+        return self._sessions
+
+    def _save(self):
+        # Cookies are credentials, keep the file private and never leave it half written
+        tmp = self.path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'wt') as fd:
+                json.dump({name: asdict(x) for name, x in self._sessions.items()}, fd)
+            os.replace(tmp, self.path)
+        except Exception:
+            self._logger.exception('Error saving session store')
+
+
+sessions = SessionStore(SESSIONS_FILE)
@@ -1,17 +1,24 @@
+import hashlib
+import logging
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from multiprocessing.dummy import Pool
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Mapping, Optional, Union
 from urllib.parse import urljoin
 
-import requests
 from lxml import html
 from lxml.html import HtmlElement
 
+from config import config
+from crawler import Crawler
+from fetch import fetcher
 from timeutils import TimeRange
 
 DOCENTI_INDEX_URL = 'https://www.orariolezioni.unimore.it//Orario/Dipartimento_di_Scienze_Fisiche-_Informatiche_e_Matematiche/2021-2022/1641/index.html'
+# 'threads' or 'asyncio'
+TIMETABLE_BACKEND = config.get('TIMETABLE_BACKEND', 'threads')
+# 'fast' or 'xpath' (the old parser, slower but simpler to adapt if the site changes)
+TABLE_PARSER = config.get('TIMETABLE_PARSER', 'fast')
 
 
 @dataclass
@@ -22,19 +29,39 @@ class TableCell:
     room: str
 
 
+@dataclass
+class PageInfo:
+    teacher: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+
+
 @dataclass
 class OrarioDocenti:
     date: datetime
     # {(teacher, weekday): Lecture}
     data: dict[(str, str), list[TableCell]]
+    # {url: PageInfo}, used to only re-parse changed pages
+    pages: dict[str, PageInfo] = field(default_factory=dict)
 
 
 def normalize_teacher_name(name: str) -> str:
     return ' '.join(sorted(name.lower().split(' ')))
 
 
-def update_docenti(last_time: Optional[datetime]) -> Optional[OrarioDocenti]:
-    data = requests.get(DOCENTI_INDEX_URL).content
+def update_docenti(last_time: Optional[datetime],
+                   prev: Union[OrarioDocenti, Callable[[], Optional[OrarioDocenti]], None] = None,
+                   crawler: Optional[Crawler] = None) -> Optional[OrarioDocenti]:
+    """Downloads the teachers timetable if it has been published after last_time.
+
+    If prev is given the refresh is incremental: every teacher page is requested conditionally
+    and only the pages whose content changed are parsed again, the others are taken from prev.
+    prev can also be a function loading the previous timetable, called only if an update is needed.
+    Teacher pages are downloaded with the given crawler (asyncio backend) or, if missing and
+    TIMETABLE_BACKEND is not 'asyncio', with the shared fetcher thread pool.
+    """
+    data = fetcher.get(DOCENTI_INDEX_URL).content
     page = html.fromstring(data)
 
     dt = re.search(r'\d+/\d+/\d+ \d+:\d+', page.xpath('//td[contains(text(), "Pubblicato il")]')[0].text).group(0)
@@ -46,25 +73,99 @@ def update_docenti(last_time: Optional[datetime]) -> Optional[OrarioDocenti]:
     profs = page.xpath('//a[contains(text(), "Orario docenti")]/../ul/li/ul/li/a')
     profs = [(normalize_teacher_name(x.text.lower()), urljoin(DOCENTI_INDEX_URL, x.get('href'))) for x in profs]
 
-    def par(teacher: str, url: str) -> {(str, str): list[TableCell]}:
-        page = html.fromstring(requests.get(url).content)
-        grid = page.xpath('//table[contains(@class, "timegrid")]')[0]
-        table = _join_table(_extract_table(grid))
-        # Add missing teacher info
-        for y in table.values():
-            for x in y:
-                x.teacher = teacher
-        return {
-            (teacher, day): cells for day, cells in table.items() if len(cells) > 0
-        }
+    if callable(prev):
+        prev = prev()
+    prev_pages = prev.pages if prev is not None else {}
+
+    if crawler is None and TIMETABLE_BACKEND == 'asyncio':
+        crawler = Crawler()
+
+    if crawler is not None:
+        olds = [_previous_page(prev_pages, teacher, url) for teacher, url in profs]
+        reqs = [(url, _conditional_headers(old)) for (_teacher, url), old in zip(profs, olds)]
+        results = [_handle_page(teacher, url, old, r.status, r.headers, r.content)
+                   for (teacher, url), old, r in zip(profs, olds, crawler.run(reqs))]
+    else:
+        def par(teacher: str, url: str) -> tuple[PageInfo, Optional[dict[(str, str), list[TableCell]]]]:
+            old = _previous_page(prev_pages, teacher, url)
+            req = fetcher.get(url, headers=_conditional_headers(old))
+            return _handle_page(teacher, url, old, req.status_code, req.headers, req.content)
+
+        results = fetcher.starmap(par, profs)
+
+    prev_data = _group_by_teacher(prev.data) if prev is not None else {}
+    combined = {}
+    pages = {}
+    changed = 0
+    for (teacher, url), (info, table) in zip(profs, results):
+        pages[url] = info
+        if table is None:
+            table = prev_data.get(teacher, {})
+        else:
+            changed += 1
+        combined.update(table)
+    logging.info(f"Timetable refreshed, {changed}/{len(profs)} teacher pages changed")
+
+    return OrarioDocenti(dt, combined, pages)
+
+
+def _previous_page(prev_pages: dict[str, PageInfo], teacher: str, url: str) -> Optional[PageInfo]:
+    old = prev_pages.get(url)
+    if old is not None and old.teacher != teacher:
+        return None
+    return old
+
+
+def _conditional_headers(old: Optional[PageInfo]) -> dict[str, str]:
+    headers = {}
+    if old is not None:
+        if old.etag is not None:
+            headers['If-None-Match'] = old.etag
+        if old.last_modified is not None:
+            headers['If-Modified-Since'] = old.last_modified
+    return headers
+
+
+def _handle_page(teacher: str, url: str, old: Optional[PageInfo], status: int, headers: Mapping[str, str],
+                 content: bytes) -> tuple[PageInfo, Optional[dict[(str, str), list[TableCell]]]]:
+    if status == 304 and old is not None:
+        return old, None
+    if status != 200:
+        raise Exception(f'Error downloading {url}: {status}')
+
+    info = PageInfo(teacher, headers.get('ETag'), headers.get('Last-Modified'), hashlib.sha1(content).hexdigest())
+    if old is not None and old.digest == info.digest:
+        return info, None
+    return info, _parse_teacher_page(teacher, content)
+
+
+def _parse_teacher_page(teacher: str, content: bytes) -> dict[(str, str), list[TableCell]]:
+    page = html.fromstring(content)
+    grid = page.xpath('//table[contains(@class, "timegrid")]')[0]
+    table = _join_table(_extract_table(grid))
+    # Add missing teacher info
+    for y in table.values():
+        for x in y:
+            x.teacher = teacher
+    return {
+        (teacher, day): cells for day, cells in table.items() if len(cells) > 0
+    }
+
+
+def _group_by_teacher(data: dict[(str, str), list[TableCell]]) -> dict[str, dict[(str, str), list[TableCell]]]:
+    res = {}
+    for (teacher, day), cells in data.items():
+        res.setdefault(teacher, {})[(teacher, day)] = cells
+    return res
 
-    results = Pool(8).starmap(par, profs)
-    combined = {k: v for d in results for k, v in d.items()}
 
-    return OrarioDocenti(dt, combined)
+def _extract_table(grid: HtmlElement) -> Dict[str, List[TableCell]]:
+    if TABLE_PARSER == 'xpath':
+        return _extract_table_xpath(grid)
+    return _extract_table_fast(grid)
 
 
-def _extract_table(grid: HtmlElement) -> Dict[str, List[TableCell]]:
+def _extract_table_xpath(grid: HtmlElement) -> Dict[str, List[TableCell]]:
     days = [x.text for x in grid.xpath('./tr[1]/td')[1:]]
     res = {day: [] for day in days}
 
@@ -97,6 +198,41 @@ def _extract_table(grid: HtmlElement) -> Dict[str, List[TableCell]]:
     return res
 
 
+def _extract_table_fast(grid: HtmlElement) -> Dict[str, List[TableCell]]:
+    # Same result as _extract_table_xpath but walks the table only once without evaluating any XPath
+    rows = [x for x in grid if x.tag == 'tr']
+    days = [x.text for x in rows[0] if x.tag == 'td'][1:]
+    res = {day: [] for day in days}
+
+    for row in rows[1:]:
+        cells = [x for x in row if x.tag == 'td']
+        trange = TimeRange.parse(cells[0].text)
+        for day, cell in zip(days, cells[1:]):
+            name, teacher, room = None, None, None
+            found = False
+
+            # Every td inside the cell is part of an inner table
+            for d in cell.iter('td'):
+                if d is cell or 'subject_pos' not in (d.get('class') or ''):
+                    continue
+                found = True
+                link = next(d.iter('a'), None)
+                if link is None:
+                    name = d.text
+                    continue
+                href = link.get('href')
+
+                if href.startswith('../Aule'):
+                    room = link.text
+                elif href.startswith('../Docenti'):
+                    teacher = normalize_teacher_name(link.text)
+
+            if found:
+                res[day].append(TableCell(trange, name, teacher, room))
+
+    return res
+
+
 def _join_table(table: Dict[str, List[TableCell]]) -> Dict[str, List[TableCell]]:
     def dedup_day(cells: list[TableCell]):
         res = []
@@ -118,22 +254,52 @@ def _join_table(table: Dict[str, List[TableCell]]) -> Dict[str, List[TableCell]]
     return {day: dedup_day(entries) for day, entries in table.items()}
 
 
-def get_lectures(tab: OrarioDocenti, day: str, lectures: list[tuple[str, str]]) -> list[TableCell]:
+class LectureIndex:
+    """Lectures of a timetable indexed by normalized (teacher, weekday, lecture name)"""
+    def __init__(self, tab: Optional[OrarioDocenti] = None):
+        self._data = {}  # type: dict[tuple[str, str, str], list[TableCell]]
+        if tab is not None:
+            self.add(tab.data)
+
+    def add(self, data: dict[(str, str), list[TableCell]]):
+        for (teacher, day), cells in data.items():
+            for x in cells:
+                if x.name is None:
+                    continue
+                self._data.setdefault((teacher, day, x.name.lower()), []).append(x)
+
+    def get(self, teacher: str, day: str, lname: str) -> list[TableCell]:
+        return self._data.get((normalize_teacher_name(teacher), day, lname.lower()), [])
+
+
+def get_lectures(index: LectureIndex, day: str, lectures: list[tuple[str, str]]) -> list[TableCell]:
     res = []
 
     for (teacher, lname) in lectures:
-        teacher = normalize_teacher_name(teacher)
-        lname = lname.lower()
-        if (teacher, day) not in tab.data:
-            continue
-        cells = tab.data[(teacher, day)]
-        for x in cells:
-            if x.name.lower() == lname:
-                res.append(x)
+        res.extend(index.get(teacher, day, lname))
 
     return res
 
 
+def check_parsers(files: list[str]) -> bool:
+    """Checks that both the table parsers give the same result on the saved teacher pages"""
+    ok = True
+    for file in files:
+        with open(file, 'rb') as fd:
+            page = html.fromstring(fd.read())
+        for grid in page.xpath('//table[contains(@class, "timegrid")]'):
+            expected = _extract_table_xpath(grid)
+            found = _extract_table_fast(grid)
+            if expected != found:
+                ok = False
+                print(f"{file}: parsers differ\n  xpath: {expected}\n  fast:  {found}")
+    return ok
+
+
 if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'check-parsers':
+        sys.exit(0 if check_parsers(sys.argv[2:]) else 1)
     print(update_docenti(None))
 
@@ -0,0 +1,105 @@
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+from timetable import OrarioDocenti, PageInfo, TableCell
+from timeutils import TimeRange
+
+# Bump when the schema changes, stores with a different version are ignored
+STORE_VERSION = 1
+
+_SCHEMA = '''
+CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE cells(teacher TEXT NOT NULL, day TEXT NOT NULL, pos INTEGER NOT NULL,
+                   start INTEGER NOT NULL, end INTEGER NOT NULL, name TEXT, room TEXT);
+CREATE INDEX cells_teacher ON cells(teacher);
+CREATE TABLE pages(url TEXT PRIMARY KEY, teacher TEXT NOT NULL, etag TEXT, last_modified TEXT, digest TEXT NOT NULL);
+CREATE TABLE subjects(teacher TEXT NOT NULL, name TEXT NOT NULL);
+'''
+
+
+@dataclass
+class StoreMeta:
+    date: datetime
+    teacher_subjects: dict[str, set[str]]
+
+
+class TimetableStore:
+    """SQLite (WAL mode) store of a downloaded timetable.
+
+    Saves are a single transaction so a crash can never leave a partially written timetable,
+    loading only the metadata and the teacher subjects is cheap and cells can be read per teacher.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _check_version(self, conn: sqlite3.Connection) -> bool:
+        return conn.execute('PRAGMA user_version').fetchone()[0] == STORE_VERSION
+
+    def save(self, tab: OrarioDocenti, teacher_subjects: dict[str, set[str]]):
+        with closing(self._connect()) as conn, conn:
+            if not self._check_version(conn):
+                tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+                drop = ''.join(f'DROP TABLE {name};' for (name,) in tables)
+                conn.executescript('BEGIN;' + drop + _SCHEMA + f'PRAGMA user_version = {STORE_VERSION};')
+            for table in ('meta', 'cells', 'pages', 'subjects'):
+                conn.execute(f'DELETE FROM {table}')
+
+            conn.execute('INSERT INTO meta VALUES (?, ?)', ('date', tab.date.isoformat()))
+            conn.executemany('INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                (teacher, day, pos, x.trange.start, x.trange.end, x.name, x.room)
+                for (teacher, day), cells in tab.data.items()
+                for pos, x in enumerate(cells)
+            ))
+            conn.executemany('INSERT INTO pages VALUES (?, ?, ?, ?, ?)', (
+                (url, x.teacher, x.etag, x.last_modified, x.digest) for url, x in tab.pages.items()
+            ))
+            conn.executemany('INSERT INTO subjects VALUES (?, ?)', (
+                (teacher, name) for teacher, names in teacher_subjects.items() for name in names
+            ))
+
+    def load_meta(self) -> Optional[StoreMeta]:
+        with closing(self._connect()) as conn:
+            if not self._check_version(conn):
+                return None
+            row = conn.execute("SELECT value FROM meta WHERE key = 'date'").fetchone()
+            if row is None:
+                return None
+            teacher_subjects = {}
+            for teacher, name in conn.execute('SELECT teacher, name FROM subjects'):
+                teacher_subjects.setdefault(teacher, set()).add(name)
+            return StoreMeta(datetime.fromisoformat(row[0]), teacher_subjects)
+
+    def load_teachers(self, teachers: Iterable[str]) -> dict[(str, str), list[TableCell]]:
+        teachers = list(teachers)
+        with closing(self._connect()) as conn:
+            if not self._check_version(conn):
+                return {}
+            query = 'SELECT teacher, day, start, end, name, room FROM cells WHERE teacher IN ({}) ORDER BY rowid'
+            rows = conn.execute(query.format(', '.join('?' * len(teachers))), teachers)
+            return self._read_cells(rows)
+
+    def load(self) -> Optional[OrarioDocenti]:
+        meta = self.load_meta()
+        if meta is None:
+            return None
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT teacher, day, start, end, name, room FROM cells ORDER BY rowid')
+            data = self._read_cells(rows)
+            pages = {url: PageInfo(teacher, etag, last_modified, digest) for url, teacher, etag, last_modified, digest
+                     in conn.execute('SELECT url, teacher, etag, last_modified, digest FROM pages')}
+        return OrarioDocenti(meta.date, data, pages)
+
+    @staticmethod
+    def _read_cells(rows: Iterable[tuple]) -> dict[(str, str), list[TableCell]]:
+        res = {}
+        for teacher, day, start, end, name, room in rows:
+            res.setdefault((teacher, day), []).append(TableCell(TimeRange(start, end), name, teacher, room))
+        return res
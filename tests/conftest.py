@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The modules of poub import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'poub'))
+
+from fakesite import FakeBookingSite  # noqa: E402
+from stubserver import StubServer  # noqa: E402
+
+
+@pytest.fixture
+def site():
+    site = FakeBookingSite().start()
+    yield site
+    site.stop()
+
+
+@pytest.fixture
+def server():
+    server = StubServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,136 @@
+"""Local stand-in of the unimore IdP and booking pages, just enough to drive the booking flow.
+
+The IdP is served at http://127.0.0.1:<port>/idp and the booking site at http://localhost:<port>/book, the two
+host names keep their cookies apart as with the real sites.
+"""
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, quote, urlsplit
+
+
+class FakeBookingSite:
+    def __init__(self, users: Optional[dict[str, str]] = None):
+        self.users = users if users is not None else {'user': 'pw'}
+        self.lock = threading.Lock()
+        # {session token: username}
+        self.sessions = {}  # type: dict[str, str]
+        # {(username, room)}
+        self.booked = set()  # type: set[tuple[str, str]]
+        self.logins = 0
+        # {room: how many more booking submits fail}
+        self.failures = {}  # type: dict[str, int]
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def idp_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/idp'
+
+    def book_url(self, room: str) -> str:
+        return f'http://localhost:{self.port}/book?room={quote(room)}'
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def start(self) -> 'FakeBookingSite':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body: str, code: int = 200, headers: Optional[dict[str, str]] = None):
+                data = body.encode()
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _form(self) -> dict[str, str]:
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                return {k: v[0] for k, v in parse_qs(body).items()}
+
+            def _user(self) -> Optional[str]:
+                for x in (self.headers.get('Cookie') or '').split(';'):
+                    name, _, value = x.strip().partition('=')
+                    if name == 'sess':
+                        with site.lock:
+                            return site.sessions.get(value)
+                return None
+
+            def _login_form(self, relay: str, error: str = '') -> str:
+                return (f'<div class="content">{error}<form method="post" action="/idp/login">'
+                        f'<input type="hidden" name="rs" value="{relay}">'
+                        '<input id="username" name="j_username"><input id="password" name="j_password" type="password">'
+                        '<button type="submit" name="_eventId_proceed">Login</button></form></div>')
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == '/':
+                    return self._send('<html>Trovaaula</html>')
+                if url.path == '/book':
+                    user = self._user()
+                    if user is None:
+                        relay = quote(f'http://localhost:{site.port}{self.path}', safe='')
+                        return self._send('', 302, {'Location': f'{site.idp_url}/login?rs={relay}'})
+                    room = query['room']
+                    with site.lock:
+                        booked = (user, room) in site.booked
+                    if booked:
+                        return self._send('<div><span>Attenzione</span> hai altre prenotazioni</div>')
+                    return self._send('<a>Le mie presenze di oggi</a><form method="post" action="/book/insert">'
+                                      f'<input type="hidden" name="room" value="{room}">'
+                                      '<button name="act" value="ins">Inserisci</button></form>')
+                if url.path == '/idp/login':
+                    return self._send(self._login_form(query['rs']))
+                self._send('Not found', 404)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                form = self._form()
+                if url.path == '/idp/login':
+                    if site.users.get(form.get('j_username')) != form.get('j_password'):
+                        return self._send(self._login_form(form['rs'], 'Wrong credentials'))
+                    with site.lock:
+                        site.logins += 1
+                        token = secrets.token_hex(8)
+                        site.sessions[token] = form['j_username']
+                    # Posted back by javascript in a browser
+                    return self._send(f'<form method="post" action="http://localhost:{site.port}/sp/acs">'
+                                      f'<input type="hidden" name="SAMLResponse" value="{token}">'
+                                      f'<input type="hidden" name="RelayState" value="{form["rs"]}">'
+                                      '<noscript><button>Go</button></noscript></form>')
+                if url.path == '/sp/acs':
+                    return self._send('', 302, {'Location': form['RelayState'],
+                                                'Set-Cookie': f'sess={form["SAMLResponse"]}; Path=/'})
+                if url.path == '/book/insert':
+                    user = self._user()
+                    if user is None:
+                        return self._send('no permission', 403)
+                    with site.lock:
+                        if site.failures.get(form['room'], 0) > 0:
+                            site.failures[form['room']] -= 1
+                            return self._send('Internal error', 500)
+                        site.booked.add((user, form['room']))
+                    return self._send('<div class="badge">Posto: 12</div>')
+                self._send('Not found', 404)
+
+        return Handler
@@ -0,0 +1,64 @@
+"""Local HTTP/1.1 server (keep-alive) that counts connections and requests in flight"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubServer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        # Client (host, port) of every connection
+        self.peers = set()  # type: set[tuple[str, int]]
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def url(self, path: str = '/') -> str:
+        """?delay=seconds delays the answer"""
+        return f'http://127.0.0.1:{self.port}{path}'
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                delay = float(parse_qs(url.query).get('delay', ['0'])[0])
+                with server.lock:
+                    server.requests += 1
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    server.peers.add(self.client_address)
+                try:
+                    time.sleep(delay)
+                    data = url.path.encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+        return Handler
@@ -0,0 +1,117 @@
+import threading
+from typing import Optional
+
+import pykka
+import pytest
+
+from actors import browser, browserpool
+from actors.browser import BookResultType, BookTurnResultType
+from actorutil.forward import ask_forwarding
+from actorutil.scheduler import scheduler
+from building import BuildingTurn
+from fakesite import FakeBookingSite
+from timeutils import TimeRange
+
+USERS = {'a': 'pa', 'b': 'pb', 'c': 'pc'}
+
+
+class HttpWorker(browser.BrowserActor):
+    def __init__(self):
+        super().__init__('http')
+
+
+class NoBrowser:
+    """The http backend falls back to the browser, that is not available in the tests"""
+    def __init__(self, *args):
+        raise Exception('No browser')
+
+
+@pytest.fixture
+def site(monkeypatch, tmp_path):
+    # Failed bookings save the page in the working directory
+    monkeypatch.chdir(tmp_path)
+    site = FakeBookingSite(dict(USERS)).start()
+    monkeypatch.setattr(browser, 'LOGIN_URL', site.idp_url)
+    monkeypatch.setattr(browser, 'BrowserInteractor', NoBrowser)
+    monkeypatch.setattr(browserpool, 'BrowserActor', HttpWorker)
+    monkeypatch.setattr(browserpool, 'BOOKING_BACKOFF', 0.05)
+    # The workers use the shared session store
+    monkeypatch.setattr(browser.sessions, 'path', str(tmp_path / 'sessions.json'))
+    monkeypatch.setattr(browser.sessions, '_sessions', None)
+    yield site
+    pykka.ActorRegistry.stop_all()
+    site.stop()
+
+
+def book(pool, users: dict[str, set[BuildingTurn]], timeout: Optional[float] = None) -> dict:
+    results = {}
+    done = threading.Event()
+
+    def on_result(username, res):
+        results[username] = res
+        if len(results) == len(users):
+            done.set()
+
+    for username, turns in users.items():
+        ask_forwarding(pool, 'process_bookings', username, USERS[username], turns,
+                       then=lambda res, username=username: on_result(username, res), timeout=timeout)
+    assert done.wait(10)
+    return results
+
+
+def turn(site, room: str, trange: TimeRange = TimeRange(9 * 60, 11 * 60)) -> BuildingTurn:
+    return BuildingTurn(room, trange, site.book_url(room))
+
+
+def test_parallel_bookings(site):
+    pool = browserpool.BrowserPoolActor.start(2)
+    results = book(pool, {x: {turn(site, x + '1'), turn(site, x + '2')} for x in USERS})
+
+    assert site.booked == {(x, x + n) for x in USERS for n in '12'}
+    for res in results.values():
+        assert res.type == BookResultType.OK
+        assert len(res.booked) == 2 and len(res.remaining) == 0
+        assert all(x.res == BookTurnResultType.OK for x in res.booked)
+
+
+def test_deadline_wake_cancelled(site):
+    pool = browserpool.BrowserPoolActor.start(2)
+    pending = set(scheduler._pending)
+    results = book(pool, {x: {turn(site, x + '1')} for x in USERS}, timeout=browserpool.BOOKING_REPLY_MARGIN + 60)
+    assert all(x.type == BookResultType.OK for x in results.values())
+    # No dispatch left scheduled at the deadline of the replied bookings
+    assert set(scheduler._pending) <= pending
+
+
+def test_retry(site, monkeypatch):
+    # Retry whatever the time of the day, the turns may have started already
+    monkeypatch.setattr(browserpool, '_turn_deadline', lambda turn, now: now + browserpool.BOOKING_DEADLINE)
+    site.failures = {'a1': 1, 'b1': 100}
+    pool = browserpool.BrowserPoolActor.start(1)
+    results = book(pool, {'a': {turn(site, 'a1')}, 'b': {turn(site, 'b1'), turn(site, 'b2')}})
+
+    assert results['a'].type == BookResultType.OK
+    assert [x.info.room for x in results['a'].booked] == ['a1']
+    # Given up after BOOKING_ATTEMPTS
+    assert results['b'].type == BookResultType.UNKNOWN_ERR
+    assert [x.room for x in results['b'].remaining] == ['b1']
+    assert [x.info.room for x in results['b'].booked] == ['b2']
+    assert site.failures['b1'] == 100 - browserpool.BOOKING_ATTEMPTS
+
+
+def test_started_turn_not_retried(site):
+    site.failures = {'a1': 1}
+    pool = browserpool.BrowserPoolActor.start(1)
+    # The turn started in the morning: attempted once anyway, but not retried
+    results = book(pool, {'a': {turn(site, 'a1', TimeRange(0, 1))}})
+    assert [x.room for x in results['a'].remaining] == ['a1']
+    assert site.failures['a1'] == 0
+
+
+def test_login_failed(site):
+    site.users['a'] = 'changed'
+    pool = browserpool.BrowserPoolActor.start(1)
+    results = book(pool, {'a': {turn(site, 'a1'), turn(site, 'a2')}})
+    assert results['a'].type == BookResultType.LOGIN_FAILED
+    assert len(results['a'].remaining) == 2
+    assert site.booked == set()
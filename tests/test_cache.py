@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from cache import SingleFlightCache
+
+
+def test_single_flight():
+    cache = SingleFlightCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('k', load))) for _ in range(5)]
+    threads[0].start()
+    assert started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    # Let the other callers find the load in flight
+    while cache.stats().waits < 4:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert cache.stats().misses == 1 and cache.stats().waits == 4
+
+
+def test_error_not_cached():
+    cache = SingleFlightCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError('down')
+
+    errors = []
+
+    def get():
+        try:
+            cache.get('k', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(3)]
+    threads[0].start()
+    assert started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    while cache.stats().waits < 2:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    # Every waiter gets the error of the load
+    assert len(errors) == 3 and all(x is errors[0] for x in errors)
+    assert cache.get('k', lambda: 'value') == 'value'
+
+
+def test_stamp():
+    cache = SingleFlightCache()
+    assert cache.get('k', lambda: 'monday', stamp=1) == 'monday'
+    assert cache.get('k', lambda: 'other', stamp=1) == 'monday'
+    # A new stamp makes the entry stale
+    assert cache.get('k', lambda: 'tuesday', stamp=2) == 'tuesday'
+
+
+def test_ttl():
+    cache = SingleFlightCache(ttl=0.05)
+    assert cache.get('k', lambda: 1) == 1
+    assert cache.get('k', lambda: 2) == 1
+    time.sleep(0.1)
+    assert cache.get('k', lambda: 3) == 3
+
+
+def test_lru_eviction():
+    cache = SingleFlightCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    # 'a' becomes the most recently used
+    assert cache.get('a', lambda: pytest.fail('a reloaded')) == 1
+    cache.put('c', 3)
+
+    assert cache.stats().evictions == 1
+    assert cache.get('b', lambda: 'reloaded') == 'reloaded'
+    assert cache.get('c', lambda: pytest.fail('c reloaded')) == 3
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from crawler import Crawler
+
+
+def test_results_in_order(server):
+    urls = [server.url(f'/{i}?delay={0.05 * (5 - i)}') for i in range(5)]
+    res = Crawler(concurrency=5).run([(x, {}) for x in urls])
+    assert [x.content for x in res] == [f'/{i}'.encode() for i in range(5)]
+    assert all(x.status == 200 for x in res)
+
+
+def test_concurrency(server):
+    start = time.monotonic()
+    Crawler(concurrency=3).run([(server.url(f'/{i}?delay=0.2'), {}) for i in range(9)])
+    assert server.max_active == 3
+    # Three rounds of three requests
+    assert time.monotonic() - start >= 0.6
+    assert len(server.peers) <= 3
+
+
+def test_timeout(server):
+    with pytest.raises(asyncio.TimeoutError):
+        Crawler(timeout=0.2).run([(server.url('/slow?delay=1'), {}), (server.url('/fast'), {})])
+
+
+def test_cancel(server):
+    crawler = Crawler()
+    threading.Timer(0.2, crawler.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(asyncio.CancelledError):
+        crawler.run([(server.url(f'/{i}?delay=2'), {}) for i in range(4)])
+    assert time.monotonic() - start < 1.5
@@ -0,0 +1,44 @@
+import pytest
+import requests
+
+from fetch import Fetcher
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher(workers=8, host_limit=2)
+    yield fetcher
+    fetcher.close()
+
+
+def test_keep_alive(server, fetcher):
+    for i in range(5):
+        assert fetcher.get(server.url(f'/page{i}')).content == f'/page{i}'.encode()
+    # Every request went through the same connection
+    assert len(server.peers) == 1
+
+
+def test_host_limit(server, fetcher):
+    res = fetcher.starmap(lambda i: fetcher.get(server.url(f'/{i}?delay=0.1')).status_code, [(i,) for i in range(8)])
+    assert res == [200] * 8
+    assert server.max_active == 2
+    # No more connections than the requests allowed in flight
+    assert len(server.peers) <= 2
+
+
+def test_stats(server, fetcher):
+    fetcher.get(server.url('/abc'))
+    with pytest.raises(requests.ConnectionError):
+        fetcher.get('http://127.0.0.1:1/')
+    stats = fetcher.stats()
+    ok = stats[f'127.0.0.1:{server.port}']
+    assert (ok.requests, ok.errors, ok.bytes) == (1, 0, 4)
+    assert stats['127.0.0.1:1'].errors == 1
+
+
+def test_close(server, fetcher):
+    fetcher.get(server.url('/'))
+    fetcher.close()
+    # Can be used again after closing, with a new session
+    fetcher.get(server.url('/'))
+    assert len(server.peers) == 2
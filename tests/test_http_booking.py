@@ -0,0 +1,54 @@
+import pytest
+
+from actors import browser
+from actors.browser import AlreadyBooked, HttpInteractor, LoginException
+from sessions import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path / 'sessions.json'))
+
+
+@pytest.fixture(autouse=True)
+def fake_idp(site, monkeypatch):
+    monkeypatch.setattr(browser, 'LOGIN_URL', site.idp_url)
+
+
+def test_book_one(site, store):
+    http = HttpInteractor(store)
+    timing = browser.BookTiming()
+    assert http.book_one('user', 'pw', site.book_url('A1'), timing) is None
+    assert site.booked == {('user', 'A1')}
+    assert site.logins == 1
+    assert list(timing.steps) == ['navigate', 'login', 'click', 'badge']
+
+    with pytest.raises(AlreadyBooked):
+        http.book_one('user', 'pw', site.book_url('A1'))
+
+
+def test_wrong_password(site, store):
+    with pytest.raises(LoginException):
+        HttpInteractor(store).book_one('user', 'wrong', site.book_url('A1'))
+    assert site.booked == set()
+    assert store.get('user') == []
+
+
+def test_saved_session(site, store):
+    HttpInteractor(store).book_one('user', 'pw', site.book_url('A1'))
+    # A new interactor (e.g. after a restart) reuses the saved session
+    HttpInteractor(store).book_one('user', 'pw', site.book_url('A2'))
+    assert site.logins == 1
+    assert site.booked == {('user', 'A1'), ('user', 'A2')}
+
+
+def test_session_expired(site, store):
+    HttpInteractor(store).book_one('user', 'pw', site.book_url('A1'))
+    site.expire_sessions()
+
+    HttpInteractor(store).book_one('user', 'pw', site.book_url('A2'))
+    assert site.logins == 2
+    assert site.booked == {('user', 'A1'), ('user', 'A2')}
+    # The new session is saved
+    HttpInteractor(store).book_one('user', 'pw', site.book_url('A3'))
+    assert site.logins == 2
@@ -0,0 +1,18 @@
+from actors.browser import _with_base
+
+BASE = '<base href="https://x.it/a/">'
+
+
+def test_base_after_head():
+    assert _with_base('<html><head><title>t</title></head></html>', 'https://x.it/a/') == \
+        f'<html><head>{BASE}<title>t</title></head></html>'
+
+
+def test_head_with_attributes():
+    source = '<HTML><HEAD lang="it"><title>t</title></HEAD><header>h</header></HTML>'
+    assert _with_base(source, 'https://x.it/a/') == \
+        f'<HTML><HEAD lang="it">{BASE}<title>t</title></HEAD><header>h</header></HTML>'
+
+
+def test_no_head():
+    assert _with_base('<header>h</header><p>p</p>', 'https://x.it/a/') == f'{BASE}<header>h</header><p>p</p>'
@@ -0,0 +1,22 @@
+import glob
+import os
+
+import pytest
+from lxml import html
+
+from timetable import _extract_table_fast, _extract_table_xpath
+
+PAGES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'poub', 'benchdata', 'docenti', '*.html')))
+
+
+def test_pages_found():
+    assert len(PAGES) > 0
+
+
+@pytest.mark.parametrize('file', PAGES, ids=os.path.basename)
+def test_parsers_agree(file):
+    with open(file, 'rb') as fd:
+        grids = html.fromstring(fd.read()).xpath('//table[contains(@class, "timegrid")]')
+    assert len(grids) > 0
+    for grid in grids:
+        assert _extract_table_fast(grid) == _extract_table_xpath(grid)